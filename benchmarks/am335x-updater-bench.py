@@ -0,0 +1,445 @@
+#!/usr/bin/env python3
+"""Benchmark am335x-updater.py against synthetic SD card images.
+
+Raw disk images (an MBR, MLO images with the expected TOC, and legacy or FIT
+U-Boot images at the usual offsets) are generated in a temporary directory, and
+then the detection, comparison, hashing and writing functions of the updater
+are timed against them. No hardware (or root) is needed. The generated data is
+the same on every run, so results can be compared between runs.
+"""
+
+from __future__ import annotations
+
+import argparse
+import contextlib
+import importlib.machinery
+import importlib.util
+import json
+import logging
+import os
+import os.path
+import random
+import shutil
+import statistics
+import struct
+import sys
+import tempfile
+import time
+import typing
+
+
+UPDATER_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "..",
+    "config",
+    "usr",
+    "sbin",
+    "am335x-updater.py",
+)
+
+
+def load_updater(path: str = UPDATER_PATH):
+    """Import am335x-updater.py (which isn't a valid module name)."""
+    loader = importlib.machinery.SourceFileLoader("am335x_updater", path)
+    spec = importlib.util.spec_from_loader(loader.name, loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+    return module
+
+
+def payload(size: int, seed: int) -> bytes:
+    """Deterministic, incompressible-looking data."""
+    return random.Random(seed).randbytes(size)
+
+
+def make_mlo(size: int, seed: int) -> bytes:
+    """Build an MLO image with a `size` byte payload."""
+    toc = bytearray(512)
+    # One CHSETTINGS TOC entry, then a terminating entry of all 0xff
+    struct.pack_into("<II12s12s", toc, 0, 0x40, 0x0c, b"", b"CHSETTINGS")
+    toc[32:64] = b"\xff" * 32
+    struct.pack_into("<IBBHI", toc, 0x40, 0xc0c0c0c1, 0, 1, 0, 0)
+    # The GP header is the payload size and load address
+    gp_header = struct.pack("<II", size, 0x402f0400)
+    return bytes(toc) + gp_header + payload(size, seed)
+
+
+def make_legacy_u_boot(size: int, seed: int) -> bytes:
+    """Build a legacy U-Boot firmware image with a `size` byte payload."""
+    header = struct.pack(
+        ">7I4B32s",
+        0x27051956, 0, 0, size, 0x80800000, 0x80800000, 0,
+        17, 2, 5, 0, b"U-Boot",
+    )
+    return header + payload(size, seed)
+
+
+def make_fdt(tree: typing.Mapping[str, typing.Any]) -> bytes:
+    """Build a flattened device tree from nested dictionaries.
+
+    Integers become single cells, strings are null-terminated, and
+    dictionaries are child nodes.
+    """
+    struct_block = bytearray()
+    strings_block = bytearray()
+    string_offsets: typing.Dict[str, int] = {}
+
+    def pad():
+        struct_block.extend(bytes(-len(struct_block) % 4))
+
+    def add_node(name: str, node: typing.Mapping[str, typing.Any]):
+        struct_block.extend(struct.pack(">I", 1))
+        struct_block.extend(name.encode("ascii") + b"\0")
+        pad()
+        for prop_name, value in node.items():
+            if isinstance(value, dict):
+                continue
+            if isinstance(value, int):
+                value = struct.pack(">I", value)
+            else:
+                value = value.encode("ascii") + b"\0"
+            if prop_name not in string_offsets:
+                string_offsets[prop_name] = len(strings_block)
+                strings_block.extend(prop_name.encode("ascii") + b"\0")
+            struct_block.extend(
+                struct.pack(">3I", 3, len(value), string_offsets[prop_name])
+            )
+            struct_block.extend(value)
+            pad()
+        for child_name, value in node.items():
+            if isinstance(value, dict):
+                add_node(child_name, value)
+        struct_block.extend(struct.pack(">I", 2))
+
+    add_node("", tree)
+    struct_block.extend(struct.pack(">I", 9))
+    header_len = 40
+    reserve_map_len = 16
+    struct_offset = header_len + reserve_map_len
+    strings_offset = struct_offset + len(struct_block)
+    total_size = strings_offset + len(strings_block)
+    header = struct.pack(
+        ">10I",
+        0xd00dfeed, total_size, struct_offset, strings_offset, header_len,
+        17, 16, 0, len(strings_block), len(struct_block),
+    )
+    return (
+        header + bytes(reserve_map_len) + bytes(struct_block)
+        + bytes(strings_block)
+    )
+
+
+def make_fit_u_boot(size: int, seed: int, dtb_count: int = 1) -> bytes:
+    """Build a FIT U-Boot image with external data.
+
+    There is one U-Boot firmware sub-image of `size` bytes, followed by
+    `dtb_count` 32 KiB flat_dt sub-images.
+    """
+    sub_images = [("u-boot", "firmware", "u-boot", size)]
+    sub_images.extend(
+        (f"fdt-{n}", "flat_dt", None, 32 * 1024) for n in range(dtb_count)
+    )
+    images: typing.Dict[str, typing.Any] = {}
+    data = bytearray()
+    for n, (name, image_type, image_os, image_size) in enumerate(sub_images):
+        node = {
+            "description": name,
+            "type": image_type,
+            "data-offset": len(data),
+            "data-size": image_size,
+        }
+        if image_os is not None:
+            node["os"] = image_os
+        images[name] = node
+        data.extend(payload(image_size, seed + n))
+        data.extend(bytes(-len(data) % 4))
+    fdt = make_fdt({"description": "U-Boot FIT", "images": images})
+    return fdt + bytes(-len(fdt) % 4) + bytes(data)
+
+
+def make_disk(
+    path: str,
+    images: typing.Iterable[typing.Tuple[int, bytes]],
+    first_partition: int = 8192,
+    sector_size: int = 512,
+) -> None:
+    """Write a raw disk image with an MBR and the given images."""
+    size = (first_partition + 2048) * sector_size
+    with open(path, "wb") as disk:
+        disk.truncate(size)
+        for offset, data in images:
+            disk.seek(offset)
+            disk.write(data)
+        mbr_entry = struct.pack(
+            "<B3sB3s2I",
+            0, b"\0\0\0", 0x83, b"\0\0\0", first_partition, 2048,
+        )
+        disk.seek(0x1be)
+        disk.write(mbr_entry)
+        disk.seek(0x1fe)
+        disk.write(b"\x55\xaa")
+
+
+class Scenario(typing.NamedTuple):
+    """A disk image layout, and the source images to check it against."""
+
+    name: str
+    mlo: bytes
+    u_boot: bytes
+    disk_images: typing.Sequence[typing.Tuple[int, bytes]]
+    first_partition: int = 8192
+
+
+def scenarios() -> typing.List[Scenario]:
+    """The layouts that are benchmarked."""
+    mlo = make_mlo(100 * 1024, 1)
+    fit = make_fit_u_boot(900 * 1024, 2)
+    legacy = make_legacy_u_boot(900 * 1024, 3)
+    big_fit = make_fit_u_boot(2 * 1024 * 1024, 4, dtb_count=64)
+    # Same size, only the last block differs
+    changed_fit = bytearray(fit)
+    changed_fit[-1] ^= 0xff
+    # A legacy header claiming an impossibly large image
+    corrupt_legacy = bytearray(legacy)
+    struct.pack_into(">I", corrupt_legacy, 12, 0xfffffff0)
+    # An FDT header claiming to be nearly 2 GiB
+    corrupt_fit = bytearray(fit)
+    struct.pack_into(">I", corrupt_fit, 4, 0x7ffffff0)
+    return [
+        Scenario(
+            "fit-current",
+            mlo,
+            fit,
+            [(0x20000, mlo), (0x40000, mlo), (0x60000, fit)],
+        ),
+        Scenario(
+            "fit-outdated-end",
+            mlo,
+            fit,
+            [(0x20000, mlo), (0x40000, mlo), (0x60000, bytes(changed_fit))],
+        ),
+        Scenario(
+            "fit-outdated",
+            make_mlo(100 * 1024, 5),
+            make_fit_u_boot(900 * 1024, 6),
+            [(0x20000, mlo), (0x40000, mlo), (0x60000, fit)],
+        ),
+        Scenario(
+            "legacy-current",
+            mlo,
+            legacy,
+            [(0x20000, mlo), (0x40000, mlo), (0x60000, legacy)],
+        ),
+        Scenario(
+            "large-fit",
+            mlo,
+            big_fit,
+            [(0x20000, mlo), (0x40000, mlo), (0x60000, big_fit)],
+            first_partition=32768,
+        ),
+        Scenario(
+            "corrupt-size",
+            mlo,
+            legacy,
+            [
+                (0x20000, mlo),
+                (0x40000, bytes(corrupt_fit)),
+                (0x60000, bytes(corrupt_legacy)),
+            ],
+        ),
+    ]
+
+
+def time_call(
+    function: typing.Callable[[], typing.Any],
+    repeat: int,
+    setup: typing.Optional[typing.Callable[[], typing.Any]] = None,
+) -> typing.Dict[str, float]:
+    """Time `function`, returning the minimum and median in seconds."""
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start_time = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start_time)
+    return {"min": min(times), "median": statistics.median(times)}
+
+
+def run_scenario(
+    updater,
+    scenario: Scenario,
+    work_dir: str,
+    repeat: int,
+) -> typing.Dict[str, typing.Dict[str, float]]:
+    """Benchmark the updater against one scenario."""
+    mlo_path = os.path.join(work_dir, f"{scenario.name}-MLO")
+    u_boot_path = os.path.join(work_dir, f"{scenario.name}-u-boot.img")
+    disk_path = os.path.join(work_dir, f"{scenario.name}.img")
+    pristine_path = f"{disk_path}.orig"
+    with open(mlo_path, "wb") as mlo_file:
+        mlo_file.write(scenario.mlo)
+    with open(u_boot_path, "wb") as u_boot_file:
+        u_boot_file.write(scenario.u_boot)
+    make_disk(
+        pristine_path,
+        scenario.disk_images,
+        first_partition=scenario.first_partition,
+    )
+    shutil.copyfile(pristine_path, disk_path)
+    FirmwareImage = updater.FirmwareImage
+    ImageKind = updater.ImageKind
+    new_mlo = FirmwareImage.from_file(mlo_path, ImageKind.MLO)
+    new_u_boot = FirmwareImage.from_file(u_boot_path, ImageKind.UBOOT)
+
+    def find():
+        return updater.find_images(disk_path)
+
+    def scan():
+        region = updater.read_boot_region(
+            disk_path,
+            scenario.first_partition * 512,
+        )
+        return updater.find_images(disk_path, region, scan=True)
+
+    def compare(hash_sources: bool):
+        # The source images are loaded each time, so nothing is cached between
+        # runs
+        return updater.load_and_compare_images(
+            mlo_path,
+            u_boot_path,
+            [disk_path],
+            hash_sources=hash_sources,
+        )
+
+    disk_images = find()
+    largest_image = max(disk_images, key=lambda i: i.size, default=None)
+
+    def hexdigest():
+        # A new image each time, so the digest isn't cached
+        image = largest_image.rebase(largest_image.offset)
+        return image.hexdigest
+
+    def hash_all():
+        # New images each time, so no digests are cached
+        return [
+            image.rebase(image.offset).compute_digest()
+            for image in disk_images
+        ]
+
+    def reset_disk():
+        shutil.copyfile(pristine_path, disk_path)
+
+    def write(journal_path: typing.Optional[str]):
+        # write_images prints progress messages
+        journal = None
+        if journal_path is not None:
+            journal = updater.UpdateJournal(journal_path)
+        with open(os.devnull, "w") as devnull, \
+                contextlib.redirect_stdout(devnull):
+            updater.write_images(
+                [
+                    updater.PendingWrite(
+                        new_mlo if image.kind is ImageKind.MLO else new_u_boot,
+                        image,
+                    )
+                    for image in disk_images
+                ],
+                journal=journal,
+            )
+        if journal is not None:
+            journal.finish()
+
+    results = {
+        "find_images": time_call(find, repeat),
+        "find_images (scan)": time_call(scan, repeat),
+        "load_and_compare_images": time_call(lambda: compare(False), repeat),
+        # The source images are also hashed for the digest cache, the reports
+        # and the journal
+        "load_and_compare (hash)": time_call(lambda: compare(True), repeat),
+    }
+    if largest_image is not None:
+        results["hexdigest"] = time_call(hexdigest, repeat)
+        # The hash phase on its own, for every image found, so the time for
+        # scanning, hashing and writing a disk can be added up.
+        results["hash (all images)"] = time_call(hash_all, repeat)
+        # Batched writes with one sync per device are the default; the
+        # journal (--journal) trades speed for recovering from interruptions.
+        results["write_images"] = time_call(
+            lambda: write(None),
+            repeat,
+            reset_disk,
+        )
+        journal_path = os.path.join(work_dir, f"{scenario.name}-journal.json")
+        results["write_images (journal)"] = time_call(
+            lambda: write(journal_path),
+            repeat,
+            reset_disk,
+        )
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--repeat", "-r",
+        type=int,
+        default=20,
+        help="How many times to run each benchmark (default: %(default)s).",
+    )
+    parser.add_argument(
+        "--scenario", "-s",
+        action="append",
+        help="Only run the named scenario. May be given more than once.",
+        dest="scenarios",
+    )
+    parser.add_argument(
+        "--json",
+        action="store_true",
+        help="Print the results as JSON instead of a table.",
+    )
+    parser.add_argument(
+        "--verbose", "-v",
+        action="store_true",
+        help="Show the updater's warnings and informational messages.",
+    )
+    parser.add_argument(
+        "--updater",
+        default=UPDATER_PATH,
+        help="Path to am335x-updater.py (default: the one in this repo).",
+    )
+    args = parser.parse_args()
+    updater = load_updater(args.updater)
+    # The pathological scenarios are expected to log warnings
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.ERROR)
+    all_results = {}
+    with tempfile.TemporaryDirectory(prefix="am335x-bench-") as work_dir:
+        for scenario in scenarios():
+            if args.scenarios and scenario.name not in args.scenarios:
+                continue
+            all_results[scenario.name] = run_scenario(
+                updater,
+                scenario,
+                work_dir,
+                args.repeat,
+            )
+    if args.json:
+        json.dump(all_results, sys.stdout, indent=2)
+        print()
+        return
+    print(
+        f"{'scenario':<18} {'benchmark':<24} "
+        f"{'min (ms)':>10} {'median (ms)':>12}"
+    )
+    for scenario_name, results in all_results.items():
+        for benchmark_name, timing in results.items():
+            min_ms = timing["min"] * 1000
+            median_ms = timing["median"] * 1000
+            print(
+                f"{scenario_name:<18} {benchmark_name:<24} "
+                f"{min_ms:>10.3f} {median_ms:>12.3f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -2,32 +2,140 @@
 
 from __future__ import annotations
 
-import argparse
 import contextlib
 import enum
 import functools
 import hashlib
 import io
+import itertools
 import logging
 import math
 import os
 import os.path
 import re
+import stat
 import struct
-import subprocess
 import sys
+import threading
+import time
 import typing
 
-import yaml
+# This script is run on every boot of slow, single-core boards, so anything
+# that's only needed some of the time (argparse, PyYAML, subprocess, json,
+# concurrent.futures...) is imported where it's used instead of here. threading
+# is imported by logging anyway, and is needed for the profiler.
+if typing.TYPE_CHECKING:
+    import argparse
+    import socket
 
 
 # Using a slightly different name for the logger to keep it Python-safe
 log = logging.getLogger("am335x_updater")
-logging.basicConfig(
-    level=logging.WARNING,
-    format="%(levelname)s: %(message)s",
-    stream=sys.stderr,
-)
+
+
+class Profiler(object):
+    """Collects timings and I/O counters, grouped by device and phase.
+
+    Phases are entered with the `phase` context manager, and counters (such as
+    "reads" and "bytes_read") are added to the innermost phase of the current
+    thread with `count`. When not `enabled`, nothing is recorded.
+    """
+
+    #: Whether anything is being recorded.
+    enabled: bool
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._stats: typing.Dict[
+            typing.Tuple[str, str],
+            typing.Dict[str, float],
+        ] = {}
+        # Each thread has its own stack of (device, phase) tuples
+        self._local = threading.local()
+
+    def _stack(self) -> typing.List[typing.Tuple[str, str]]:
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _add(self, key: typing.Tuple[str, str], counter: str, amount: float):
+        with self._lock:
+            stats = self._stats.setdefault(key, {})
+            stats[counter] = stats.get(counter, 0) + amount
+
+    @contextlib.contextmanager
+    def phase(
+        self,
+        name: str,
+        device: typing.Optional[os.PathLike] = None,
+    ) -> typing.Iterator[None]:
+        """Record the wall time of a phase.
+
+        If `device` is not given, the device of the enclosing phase is used.
+        """
+        if not self.enabled:
+            yield
+            return
+        stack = self._stack()
+        if device is not None:
+            device_name = os.fsdecode(device)
+        elif stack:
+            device_name = stack[-1][0]
+        else:
+            device_name = ""
+        key = (device_name, name)
+        stack.append(key)
+        start_time = time.monotonic()
+        try:
+            yield
+        finally:
+            stack.pop()
+            self._add(key, "calls", 1)
+            self._add(key, "seconds", time.monotonic() - start_time)
+
+    def count(self, counter: str, amount: int = 1):
+        """Add to a counter for the current phase."""
+        if not self.enabled:
+            return
+        stack = self._stack()
+        self._add(stack[-1] if stack else ("", "other"), counter, amount)
+
+    def to_json(self) -> typing.List[typing.Dict[str, typing.Any]]:
+        with self._lock:
+            return [
+                {"device": device, "phase": phase, **stats}
+                for (device, phase), stats in sorted(self._stats.items())
+            ]
+
+    def format_table(self) -> str:
+        """Format the recorded values as a table."""
+        counters = ("calls", "seconds", "reads", "bytes_read", "writes",
+            "bytes_written", "subprocesses")
+        rows = [("device", "phase") + counters]
+        for entry in self.to_json():
+            rows.append(
+                (entry["device"], entry["phase"])
+                + tuple(
+                    f"{entry.get(counter, 0):.4f}" if counter == "seconds"
+                    else str(entry.get(counter, 0))
+                    for counter in counters
+                )
+            )
+        widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+        return "\n".join(
+            "  ".join(
+                # Left-align the names, right-align the numbers
+                cell.ljust(width) if i < 2 else cell.rjust(width)
+                for i, (cell, width) in enumerate(zip(row, widths))
+            ).rstrip()
+            for row in rows
+        )
+
+
+#: Records where time is spent when --profile is given.
+profiler = Profiler()
 
 
 DEFAULT_SECTOR_SIZE = 512
@@ -37,32 +145,23 @@ def get_block_size(device: os.PathLike) -> int:
     """Look up the device block size (in bytes) in sysfs.
 
     This value is also used as the sector size in this script. If there's an
-    error in looking up the4 value, 512 is used.
+    error in looking up the value, or `device` is not a block device (for
+    example a raw disk image file), 512 is used.
     """
-    device_path: typing.Union[str, bytes]
-    if isinstance(device, os.PathLike):
-        device_path = device.__fspath__()
-    else:
-        device_path = device
-    if isinstance(device_path, str):
-        device_regex = r"(?:/dev/)?(\w+)"
-    elif isinstance(device_path, bytes):
-        device_regex = rb"(?:/dev/)?(\w+)"
-    else:
-        # This should never be reached, as the spec for os.PathLike is that
-        # __fspath__() returns either str or bytes.
-        raise RuntimeError(
-            "__fspath__() returned something other than str or bytes"
-        )
-    match = re.match(device_regex, device_path)
-    # The only way this assertion should fail is if the string given includes
-    # whitespace, or has no characters at all.
-    assert match is not None
-    device_name = match.group(1)
+    real_path = os.path.realpath(os.fsdecode(device))
+    if not stat.S_ISBLK(os.stat(real_path).st_mode):
+        log.debug(
+            "'%s' is not a block device, using %d-byte sectors",
+            device,
+            DEFAULT_SECTOR_SIZE
+        )
+        return DEFAULT_SECTOR_SIZE
+    device_name = os.path.basename(real_path)
     block_size_path = f"/sys/class/block/{device_name}/queue/logical_block_size"
     if not os.path.exists(block_size_path):
         log.warning(
-            "'%s' is not a block device, defaulting to %d-byte sectors",
+            "Unable to find the block size of '%s', defaulting to %d-byte "
+            "sectors",
             device,
             DEFAULT_SECTOR_SIZE
         )
@@ -72,19 +171,121 @@ def get_block_size(device: os.PathLike) -> int:
         return int(sys_block_size.read().strip())
 
 
-def find_mbr_first_partition(
+#: The offsets the AM335x ROM checks for MLO images when booting from a raw
+#: MMC/SD device (section 26.1.8.5 of the AM335x Reference Manual).
+RAW_BOOT_OFFSETS = (0, 0x20000, 0x40000, 0x60000)
+
+#: The size of the region at the start of a device the ROM bootloader looks at.
+BOOT_REGION_SIZE = 0x80000
+
+
+def read_boot_region(
+    device_path: os.PathLike,
+    length: int = BOOT_REGION_SIZE,
+) -> memoryview:
+    """Read the beginning of a device in a single read.
+
+    `length` should be a multiple of the device's sector size. If the device
+    (or file) is shorter than `length`, the returned buffer is also shorter.
+    """
+    buf = bytearray(length)
+    view = memoryview(buf)
+    total_read = 0
+    # Unbuffered, so that the read goes straight into `buf` instead of being
+    # split up into (and copied from) io.BufferedReader's smaller buffer.
+    with open(device_path, "rb", buffering=0) as device:
+        # readinto() on a raw file may return fewer bytes than requested, so
+        # keep going until we hit EOF or fill the buffer.
+        while total_read < length:
+            read_len = device.readinto(view[total_read:])
+            profiler.count("reads")
+            if not read_len:
+                break
+            profiler.count("bytes_read", read_len)
+            total_read += read_len
+    log.debug("Read %d bytes from the start of %s", total_read, device_path)
+    return view[:total_read]
+
+
+class BufferReader(io.RawIOBase):
+    """A read-only, seekable stream over an existing buffer.
+
+    Unlike `io.BytesIO`, the buffer is not copied, so many of these can be
+    created cheaply over slices of a `memoryview`. `read` also avoids copying,
+    returning read-only `memoryview` slices of the buffer. These are never
+    larger than what is left in the buffer, no matter how much is requested.
+    """
+
+    def __init__(self, buf: memoryview, name: typing.Any = None):
+        super().__init__()
+        self._buf = memoryview(buf).cast("B").toreadonly()
+        self._position = 0
+        self.name = name
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_SET:
+            new_position = offset
+        elif whence == os.SEEK_CUR:
+            new_position = self._position + offset
+        elif whence == os.SEEK_END:
+            new_position = len(self._buf) + offset
+        else:
+            raise ValueError(f"Invalid whence ({whence})")
+        if new_position < 0:
+            raise ValueError(f"Negative seek position {new_position}")
+        self._position = new_position
+        return self._position
+
+    def read(self, size: typing.Optional[int] = -1) -> memoryview:
+        start = min(self._position, len(self._buf))
+        if size is None or size < 0:
+            end = len(self._buf)
+        else:
+            end = min(start + size, len(self._buf))
+        self._position = end
+        return self._buf[start:end]
+
+    def readall(self) -> memoryview:
+        return self.read()
+
+    def readinto(self, b) -> int:
+        start = min(self._position, len(self._buf))
+        chunk = self._buf[start:start + len(b)]
+        b[:len(chunk)] = chunk
+        self._position = start + len(chunk)
+        return len(chunk)
+
+    def __repr__(self):
+        if self.name is not None:
+            return f"<{self.__class__.__name__} name='{self.name}'>"
+        return super().__repr__()
+
+
+#: MBR partition types for extended partitions (CHS, LBA, and Linux).
+MBR_EXTENDED_TYPES = frozenset((0x05, 0x0f, 0x85))
+
+#: The MBR partition type of a GPT protective (or hybrid) MBR entry.
+MBR_GPT_PROTECTIVE_TYPE = 0xee
+
+
+def read_mbr_entries(
     stream: io.BinaryIO,
-    sector_size: int = DEFAULT_SECTOR_SIZE,
-) -> typing.Union[int, None]:
-    """Find the offset of the first partition in an MBR.
+) -> typing.Union[typing.Sequence[typing.Tuple[int, int, int]], None]:
+    """Read the primary partition entries from an MBR.
 
     The given stream is assumed to be at offset 0 of a raw block device. If
-    there is a valid MBR, the four primary partition entries are examined, and
-    the entry with the lowest starting sector is found. The value of the
-    starting sector is then multipled by 512 to get the byte offset of the first
-    partition.
-
-    If there is not a valid MBR, or no partitions are found, `None` is returned.
+    there is a valid MBR, a (partition type, starting LBA, sector count) tuple
+    is returned for each non-empty primary partition entry. If there isn't a
+    valid MBR, `None` is returned.
     """
     starting_offset = stream.tell()
     if starting_offset != 0:
@@ -93,24 +294,24 @@ def find_mbr_first_partition(
             stream,
             starting_offset,
         )
-    # Skip forward to the boot signature and check that first
+    # The boot signature and partition entries are all in the first 512 bytes,
+    # so read them all at once.
+    mbr_buf = stream.read(0x200)
+    if len(mbr_buf) != 0x200:
+        log.warning("%s is too short to contain an MBR.", stream)
+        return None
+    # Check the boot signature first
     MBR_BOOT_SIG_OFFSET = 0x1fe
-    # Because there's a mix of absolute and relative seeking in this function,
-    # all seek() calls in it are explicit in which kind they are.
-    stream.seek(MBR_BOOT_SIG_OFFSET, os.SEEK_CUR)
-    boot_sig_buf = stream.read(2)
-    boot_sig = struct.unpack("<2B", boot_sig_buf)
+    boot_sig = struct.unpack_from("<2B", mbr_buf, MBR_BOOT_SIG_OFFSET)
     if boot_sig != (0x55, 0xaa):
         log.warning(
             "Invalid boot signature (%s) found.",
             ", ".join(f"{n:#x}" for n in boot_sig)
         )
         return None
-    stream.seek(starting_offset, os.SEEK_SET)
     # Partition entries start at 0x1be, and are 16 bytes long. They follow one
     # after another four times, for a total of 64 bytes
     MBR_FIRST_PART_ENTRY = 0x1be
-    stream.seek(MBR_FIRST_PART_ENTRY, os.SEEK_CUR)
     # Each partition entry has:
     # * flags (1 byte)
     # * CHS start (3 bytes, packed format)
@@ -123,11 +324,13 @@ def find_mbr_first_partition(
     # interested in the LBA of the starting sector, so I don't care about the
     # CHS values and don't need to unpack them.
     mbr_entry_format = "<B3sB3s2I"
-    lowest_starting_sector = 0xffffffff
+    entries = []
     for i in range(4):
-        entry_buf = stream.read(16)
-        # All zeros is an empty entry which we can skip
-        if not any(entry_buf):
+        entry_offset = MBR_FIRST_PART_ENTRY + 16 * i
+        entry_buf = mbr_buf[entry_offset:entry_offset + 16]
+        # All zeros is an empty entry which we can skip, as is an entry with
+        # a partition type of 0.
+        if not any(entry_buf) or entry_buf[4] == 0:
             continue
         partition_entry = struct.unpack(mbr_entry_format, entry_buf)
         log.debug(
@@ -140,13 +343,178 @@ def find_mbr_first_partition(
                 for n in partition_entry
             )
         )
-        if partition_entry[4] < lowest_starting_sector:
-            lowest_starting_sector = partition_entry[4]
-            log.debug(
-                "New lowest starting sector of %s (%#x)",
-                lowest_starting_sector,
-                lowest_starting_sector,
-            )
+        entries.append((
+            partition_entry[2],
+            partition_entry[4],
+            partition_entry[5],
+        ))
+    return entries
+
+
+class InvalidGPT(Exception):
+    """Exception for when a GPT header or partition entry array is invalid."""
+    pass
+
+
+#: The signature at the start of a GPT header.
+GPT_SIGNATURE = b"EFI PART"
+
+#: The format of a GPT header, up to (and including) the partition entry array
+#: CRC32. All values are little-endian.
+GPT_HEADER_FORMAT = "<8s4sII4xQQQQ16sQIII"
+GPT_HEADER_LEN = struct.calcsize(GPT_HEADER_FORMAT)
+
+
+def find_gpt_first_partition(
+    stream: io.BinaryIO,
+    sector_size: int = DEFAULT_SECTOR_SIZE,
+) -> typing.Union[int, None]:
+    """Find the starting LBA of the first partition in a GPT.
+
+    The given stream is assumed to be at offset 0 of a raw block device. The
+    primary GPT header (at LBA 1) is read, and both it and the partition entry
+    array it points to are checked against their CRC32s. The lowest starting
+    LBA of all of the used partition entries is returned, or `None` if there
+    are no partitions. `InvalidGPT` is raised if the header or partition
+    entries are invalid, or can't be read from `stream`.
+
+    Only the primary GPT is checked, as the backup GPT is at the end of the
+    device.
+    """
+    import zlib
+
+    stream.seek(sector_size, os.SEEK_SET)
+    header_buf = stream.read(sector_size)
+    if len(header_buf) < GPT_HEADER_LEN:
+        raise InvalidGPT(f"{stream} is too short to contain a GPT header")
+    (
+        signature,
+        revision,
+        header_size,
+        header_crc,
+        current_lba,
+        backup_lba,
+        first_usable_lba,
+        last_usable_lba,
+        disk_guid,
+        entries_lba,
+        entry_count,
+        entry_size,
+        entries_crc,
+    ) = struct.unpack_from(GPT_HEADER_FORMAT, header_buf)
+    if signature != GPT_SIGNATURE:
+        raise InvalidGPT(f"No GPT header signature found in {stream}")
+    if not GPT_HEADER_LEN <= header_size <= len(header_buf):
+        raise InvalidGPT(f"Invalid GPT header size ({header_size})")
+    # The header CRC is calculated with the CRC field itself set to 0
+    header_check_buf = bytearray(header_buf[:header_size])
+    header_check_buf[16:20] = bytes(4)
+    if zlib.crc32(header_check_buf) != header_crc:
+        raise InvalidGPT(f"GPT header CRC in {stream} does not match")
+    if current_lba != 1:
+        raise InvalidGPT(
+            f"GPT header in {stream} is not the primary header (it says it is "
+            f"at LBA {current_lba})"
+        )
+    # Each entry has a partition type GUID, a unique GUID, and then the
+    # starting and ending LBAs. Anything past that isn't needed.
+    GPT_ENTRY_MIN_LEN = 48
+    if entry_size < GPT_ENTRY_MIN_LEN or entry_size % 8 != 0:
+        raise InvalidGPT(f"Invalid GPT partition entry size ({entry_size})")
+    entries_len = entry_count * entry_size
+    stream.seek(entries_lba * sector_size, os.SEEK_SET)
+    entries_buf = stream.read(entries_len)
+    if len(entries_buf) != entries_len:
+        raise InvalidGPT(
+            f"GPT partition entries in {stream} (at LBA {entries_lba}) could "
+            "not be read"
+        )
+    if zlib.crc32(entries_buf) != entries_crc:
+        raise InvalidGPT(f"GPT partition entry CRC in {stream} does not match")
+    log.debug(
+        "GPT with %d %d-byte entries at LBA %d, usable LBAs %d-%d",
+        entry_count,
+        entry_size,
+        entries_lba,
+        first_usable_lba,
+        last_usable_lba,
+    )
+    lowest_starting_lba = None
+    for i in range(entry_count):
+        type_guid, unique_guid, start_lba, end_lba = struct.unpack_from(
+            "<16s16sQQ",
+            entries_buf,
+            i * entry_size,
+        )
+        # Unused entries have a type GUID of all zeros
+        if not any(type_guid):
+            continue
+        log.debug(
+            "GPT partition entry %d: LBAs %d-%d, type %s",
+            i,
+            start_lba,
+            end_lba,
+            type_guid.hex(),
+        )
+        if lowest_starting_lba is None or start_lba < lowest_starting_lba:
+            lowest_starting_lba = start_lba
+    return lowest_starting_lba
+
+
+def find_first_partition(
+    stream: io.BinaryIO,
+    sector_size: int = DEFAULT_SECTOR_SIZE,
+) -> typing.Union[int, None]:
+    """Find the offset of the first partition on a device.
+
+    The given stream is assumed to be at offset 0 of a raw block device, and is
+    expected to be the start of the device that has already been read into
+    memory (see `read_boot_region`), as GPTs need a few seeks. MBR, GPT (with a
+    protective MBR), and hybrid MBR/GPT partition tables are supported, and the
+    byte offset of the partition with the lowest starting sector is returned.
+
+    For extended partitions, the extended partition itself is used, as the
+    first extended boot record is at its start, and every logical partition is
+    inside of it. If there's a GPT, the partitions in both it and the MBR (for
+    hybrid MBRs) are checked.
+
+    If there is not a valid partition table, or no partitions are found, `None`
+    is returned.
+    """
+    mbr_entries = read_mbr_entries(stream)
+    if mbr_entries is None:
+        return None
+    starting_lbas = []
+    has_gpt = False
+    for partition_type, start_lba, sector_count in mbr_entries:
+        if partition_type == MBR_GPT_PROTECTIVE_TYPE:
+            # This covers the GPT itself (and normally the rest of the disk),
+            # so it isn't a real partition.
+            has_gpt = True
+            continue
+        if partition_type in MBR_EXTENDED_TYPES:
+            log.debug("Extended partition found at LBA %d", start_lba)
+        starting_lbas.append(start_lba)
+    if has_gpt:
+        try:
+            gpt_lba = find_gpt_first_partition(stream, sector_size)
+        except InvalidGPT as exc:
+            # Any partitions in a hybrid MBR are only a subset of the GPT
+            # partitions, so there's no way to tell where the first partition
+            # really is.
+            log.warning("Invalid GPT: %s", exc)
+            return None
+        if gpt_lba is not None:
+            starting_lbas.append(gpt_lba)
+    if not starting_lbas:
+        log.warning("No partitions found on %s", stream)
+        return None
+    lowest_starting_sector = min(starting_lbas)
+    log.debug(
+        "Lowest starting sector of %s (%#x)",
+        lowest_starting_sector,
+        lowest_starting_sector,
+    )
     return sector_size * lowest_starting_sector
 
 
@@ -188,13 +556,19 @@ def get_mlo_toc_size(
             starting_offset
         )
     # Read the size of the image right after the TOC. The first 4 bytes are a
-    # little-endian unsigned int representing the size of the image in bytes.
-    # The size does not include the TOC size.
+    # little-endian unsigned int representing the size of the image in bytes,
+    # and the next 4 bytes are the load address. Together they make up the 8
+    # byte GP header. The size does not include the TOC or the GP header.
+    GP_HEADER_LEN = 8
     # Relying on the read position of stream being where it was left from
     # reading the TOC.
     image_len_buf = stream.read(4)
+    if len(image_len_buf) != 4:
+        raise InvalidFirmwareImage(
+            f"MLO image at {stream}, offset {starting_offset:#x} is truncated"
+        )
     image_len = struct.unpack_from("<I", image_len_buf)[0]
-    return image_len + TOC_LEN
+    return image_len + TOC_LEN + GP_HEADER_LEN
 
 
 class InvalidUBootImage(InvalidFirmwareImage):
@@ -213,6 +587,8 @@ def get_u_boot_legacy_size(
     """
     U_BOOT_HEADER_LEN = 64
     header_buf = stream.read(U_BOOT_HEADER_LEN)
+    if len(header_buf) != U_BOOT_HEADER_LEN:
+        raise InvalidFirmwareImage("Too short for a legacy U-Boot header")
     # This format spec is based on the U-Boot sources, specifically the
     # definition of image_header_t in include/image.h
     header_format = ">7I4B32s"
@@ -242,6 +618,241 @@ def align_up(n: int, align_to: int) -> int:
     return align_to * math.ceil(n / align_to)
 
 
+#: Whether FIT images parsed in-process should also be decompiled with dtc, and
+#: the results compared. This is only useful for debugging the FDT parser.
+DTC_CROSS_CHECK = False
+
+
+# Token values and header layout from the Devicetree Specification, section 5.
+FDT_MAGIC = 0xd00dfeed
+FDT_BEGIN_NODE = 0x1
+FDT_END_NODE = 0x2
+FDT_PROP = 0x3
+FDT_NOP = 0x4
+FDT_END = 0x9
+FDT_HEADER_FORMAT = ">10I"
+FDT_HEADER_LEN = struct.calcsize(FDT_HEADER_FORMAT)
+
+
+class FDTHeader(typing.NamedTuple):
+    """The header of a flattened device tree."""
+
+    magic: int
+    totalsize: int
+    off_dt_struct: int
+    off_dt_strings: int
+    off_mem_rsvmap: int
+    version: int
+    last_comp_version: int
+    boot_cpuid_phys: int
+    size_dt_strings: int
+    size_dt_struct: int
+
+
+def parse_fdt(buf: bytes) -> typing.Dict[str, typing.Any]:
+    """Parse a flattened device tree (FDT) blob into nested dictionaries.
+
+    The root node is returned. Each node is a dictionary, with child nodes
+    stored as dictionaries and properties stored as their raw `bytes` values,
+    both keyed by name. If the blob is malformed, `InvalidFirmwareImage` is
+    raised.
+    """
+    data = memoryview(buf)
+    try:
+        header = FDTHeader._make(struct.unpack_from(FDT_HEADER_FORMAT, data))
+    except struct.error as exc:
+        raise InvalidFirmwareImage("FDT is too short for a header") from exc
+    if header.magic != FDT_MAGIC:
+        raise InvalidFirmwareImage("Incorrect FDT magic number")
+    # Version 16 is the oldest version with the same struct block format as the
+    # current specification, and is what dtc has generated for a long time.
+    if header.last_comp_version > 17 or header.version < 16:
+        raise InvalidFirmwareImage(
+            f"Unsupported FDT version {header.version}"
+        )
+    if header.totalsize > len(data):
+        raise InvalidFirmwareImage(
+            f"FDT is truncated ({len(data)} of {header.totalsize} bytes)"
+        )
+    struct_end = header.off_dt_struct + header.size_dt_struct
+    strings_end = header.off_dt_strings + header.size_dt_strings
+    if struct_end > header.totalsize or strings_end > header.totalsize:
+        raise InvalidFirmwareImage("FDT blocks extend past the end of the FDT")
+    struct_block = bytes(data[header.off_dt_struct:struct_end])
+    strings_block = bytes(data[header.off_dt_strings:strings_end])
+
+    def read_string(block: bytes, offset: int) -> typing.Tuple[str, int]:
+        # Returns the decoded string, and the offset of the terminating null.
+        end = block.index(b"\0", offset)
+        return block[offset:end].decode("ascii"), end
+
+    # The struct block is a flat sequence of tokens, so nesting is tracked with
+    # an explicit stack of the nodes currently open.
+    root: typing.Dict[str, typing.Any] = {}
+    stack: typing.List[typing.Dict[str, typing.Any]] = []
+    offset = 0
+    try:
+        while True:
+            (token,) = struct.unpack_from(">I", struct_block, offset)
+            offset += 4
+            if token == FDT_BEGIN_NODE:
+                # Node names are inline in the struct block, and padded out to
+                # a 4-byte boundary.
+                name, end = read_string(struct_block, offset)
+                offset = align_up(end + 1, 4)
+                if not stack:
+                    node = root
+                else:
+                    node = {}
+                    stack[-1][name] = node
+                stack.append(node)
+            elif token == FDT_END_NODE:
+                stack.pop()
+            elif token == FDT_PROP:
+                prop_len, name_offset = struct.unpack_from(
+                    ">2I", struct_block, offset
+                )
+                offset += 8
+                if offset + prop_len > len(struct_block):
+                    raise InvalidFirmwareImage(
+                        "FDT property extends past the struct block"
+                    )
+                name, _ = read_string(strings_block, name_offset)
+                stack[-1][name] = struct_block[offset:offset + prop_len]
+                offset = align_up(offset + prop_len, 4)
+            elif token == FDT_NOP:
+                continue
+            elif token == FDT_END:
+                break
+            else:
+                raise InvalidFirmwareImage(
+                    f"Unknown FDT token {token:#x} at {offset - 4:#x}"
+                )
+    except (struct.error, ValueError, IndexError) as exc:
+        # struct.error is raised when reading past the end of the struct block,
+        # ValueError for missing string terminators (or non-ASCII names), and
+        # IndexError for properties or END_NODE tokens outside of any node.
+        raise InvalidFirmwareImage("Malformed FDT struct block") from exc
+    if stack:
+        raise InvalidFirmwareImage("FDT struct block ended inside a node")
+    return root
+
+
+def fdt_property_u32(value: bytes) -> int:
+    """Decode an FDT property value holding a single 32-bit cell."""
+    if len(value) != 4:
+        raise InvalidFirmwareImage(
+            f"Expected a 4-byte cell, found {len(value)} bytes"
+        )
+    return struct.unpack(">I", value)[0]
+
+
+def fdt_property_str(value: bytes) -> str:
+    """Decode an FDT property value holding a string.
+
+    For string lists, only the first string is returned.
+    """
+    try:
+        return value.split(b"\0", 1)[0].decode("ascii")
+    except UnicodeDecodeError as exc:
+        raise InvalidFirmwareImage("Non-ASCII FDT string property") from exc
+
+
+class FITImageInfo(typing.NamedTuple):
+    """The properties of a FIT sub-image used to size a FIT image."""
+
+    offset: int
+    size: int
+    type: typing.Optional[str]
+    os: typing.Optional[str]
+
+
+def get_fit_images(fdt_data: bytes) -> typing.Dict[str, FITImageInfo]:
+    """Extract the sub-image information from a FIT image's FDT."""
+    images = parse_fdt(fdt_data).get("images")
+    if not isinstance(images, dict):
+        raise InvalidFirmwareImage("No images node in FIT image")
+    fit_images = {}
+    for name, image_data in images.items():
+        # Skip any properties of the images node itself
+        if not isinstance(image_data, dict):
+            continue
+        try:
+            image_offset = fdt_property_u32(image_data["data-offset"])
+            image_size = fdt_property_u32(image_data["data-size"])
+        except KeyError as exc:
+            raise InvalidFirmwareImage(
+                f"FIT sub-image '{name}' is missing {exc}"
+            ) from exc
+        image_type = image_data.get("type")
+        image_os = image_data.get("os")
+        fit_images[name] = FITImageInfo(
+            image_offset,
+            image_size,
+            None if image_type is None else fdt_property_str(image_type),
+            None if image_os is None else fdt_property_str(image_os),
+        )
+    return fit_images
+
+
+def get_fit_images_dtc(fdt_data: bytes) -> typing.Dict[str, FITImageInfo]:
+    """Extract the sub-image information from a FIT image using dtc.
+
+    This is the same as `get_fit_images`, but the FDT is decompiled to DTS and
+    then converted to YAML with dtc, and the YAML is parsed to find the images.
+    It is much slower, and is only kept to cross-check the in-process parser.
+    """
+    import subprocess
+
+    import yaml
+
+    profiler.count("subprocesses", 2)
+    decompile = subprocess.run(
+        ["/usr/bin/dtc", "-I", "dtb", "-O", "dts", "-o", "-", "-"],
+        input=fdt_data,
+        stdout=subprocess.PIPE,
+        check=True,
+    )
+    yaml_convert = subprocess.run(
+        ["/usr/bin/dtc", "-I", "dts", "-O", "yaml", "-o", "-", "-"],
+        input=decompile.stdout,
+        stdout=subprocess.PIPE,
+        check=True,
+    )
+    fit_yaml = yaml.safe_load_all(yaml_convert.stdout)
+    fit_images = {}
+    try:
+        # We only care about the first document, and the first tree in that
+        # document.
+        images = next(iter(fit_yaml))[0]["images"]
+        for name, image_data in images.items():
+            # The data-[size,offset] properties have only one value. Wrap
+            # `None` in an list to emulate how DTS has almost everything as a
+            # list.
+            fit_images[name] = FITImageInfo(
+                image_data["data-offset"][0][0],
+                image_data["data-size"][0][0],
+                image_data.get("type", [None])[0],
+                image_data.get("os", [None])[0],
+            )
+    except (KeyError, IndexError) as exc:
+        raise InvalidFirmwareImage("Invalid access in FIT parsing") from exc
+    return fit_images
+
+
+def stream_remaining(stream: io.BinaryIO) -> typing.Optional[int]:
+    """Return how many bytes are left in a stream after its current position.
+
+    `None` is returned if the stream is not seekable.
+    """
+    if not stream.seekable():
+        return None
+    position = stream.tell()
+    end = stream.seek(0, os.SEEK_END)
+    stream.seek(position)
+    return max(end - position, 0)
+
+
 def get_u_boot_fit_size(
     stream: io.BinaryIO,
 ) -> int:
@@ -255,72 +866,69 @@ def get_u_boot_fit_size(
     # The first 8 bytes of a flattened device tree (FDT) are a magic number, and
     # the total size of the FDT.
     buf = stream.read(8)
+    if len(buf) != 8:
+        raise InvalidFirmwareImage(
+            f"{stream} at {starting_offset:#x} is too short for an FDT"
+        )
     magic, fdt_len = struct.unpack(">2I", buf)
-    if magic != 0xd00dfeed:
+    if magic != FDT_MAGIC:
         raise InvalidFirmwareImage(
             f"Magic number for {stream} at {starting_offset:#x} does not match"
             " for an FDT"
         )
+    if fdt_len < FDT_HEADER_LEN:
+        raise InvalidFirmwareImage(
+            f"FDT size for {stream} at {starting_offset:#x} is too small"
+        )
+    # The size comes straight from the device, so make sure it's plausible
+    # before reading (and allocating) that much.
+    remaining = stream_remaining(stream)
+    if fdt_len > MAX_IMAGE_SIZE or (
+        remaining is not None and fdt_len - len(buf) > remaining
+    ):
+        raise InvalidFirmwareImage(
+            f"FDT size for {stream} at {starting_offset:#x} ({fdt_len} bytes) "
+            "is too large"
+        )
     # Extract the FDT from the device (and only the FDT, which we can do because
-    # the size is now known). Feed it into dtc to decompile it, then convert the
-    # DTS to YAML for easier parsing.
-    stream.seek(starting_offset, os.SEEK_SET)
-    read_pipe, write_pipe = os.pipe()
-    # Fork so we can have a process feed the data in to the pipe.
-    if os.fork() != 0:
-        os.close(write_pipe)
-    else:
-        os.close(read_pipe)
-        fdt_data = stream.read(fdt_len)
-        os.write(write_pipe, fdt_data)
-        os.close(write_pipe)
-        sys.exit()
-    decompile = subprocess.Popen(
-        ["/usr/bin/dtc", "-I", "dtb", "-O", "dts", "-o", "-", "-"],
-        stdin=read_pipe,
-        stdout=subprocess.PIPE,
-        close_fds=True,
-    )
-    yaml_convert = subprocess.Popen(
-        ["/usr/bin/dtc", "-I", "dts", "-O", "yaml", "-o", "-", "-"],
-        stdin=decompile.stdout,
-        stdout=subprocess.PIPE,
-    )
-    fit_yaml = yaml.safe_load_all(yaml_convert.communicate()[0])
+    # the size is now known), and parse it in-process. It's read again from
+    # the start in one piece, so a `BufferReader` can return it without
+    # copying.
+    stream.seek(starting_offset)
+    fdt_data = stream.read(fdt_len)
+    fit_images = get_fit_images(fdt_data)
+    if DTC_CROSS_CHECK:
+        dtc_images = get_fit_images_dtc(fdt_data)
+        if dtc_images != fit_images:
+            log.error(
+                "FIT parsing mismatch for %s at %#x: %s (in-process) vs %s "
+                "(dtc)",
+                stream,
+                starting_offset,
+                fit_images,
+                dtc_images,
+            )
+            raise InvalidFirmwareImage("FIT parsing results do not match dtc")
     # FIT uses the DTS format, with a couple of differences. We only care about
     # the "images" nodes. To figure out the size of the FIT image, we look at
     # the "data-size" and "data-offset" properties of the image nodes.
-    try:
-        # We only care about the first document, and the first tree in that
-        # document.
-        images = next(iter(fit_yaml))[0]["images"]
-        largest_offset = 0
-        offset_size = 0
-        uboot_image_found = False
-        for image_data in images.values():
-            # The data-[size,offset] properties have only one value
-            image_offset = image_data["data-offset"][0][0]
-            image_size = image_data["data-size"][0][0]
-            # Wrap `None` in an list to emulate how DTS has almost everything as
-            # a list.
-            image_type = image_data.get("type", [None])[0]
-            image_os = image_data.get("os", [None])[0]
-            log.debug(
-                # Stringifying image_type and image_os so that integers turn
-                # into base-10 strings, and `None` turns into "None"
-                "Found image with offset %#x, size %d, type %s, OS %s",
-                image_offset,
-                image_size,
-                str(image_type),
-                str(image_os),
-            )
-            if image_offset > largest_offset:
-                largest_offset = image_offset
-                offset_size = image_size
-            if image_type == "firmware" and image_os == "u-boot":
-                uboot_image_found = True
-    except (KeyError, IndexError) as exc:
-        raise InvalidFirmwareImage("Invalid access in FIT parsing") from exc
+    largest_offset = 0
+    offset_size = 0
+    uboot_image_found = False
+    for image in fit_images.values():
+        log.debug(
+            # Stringifying the type and OS so that `None` turns into "None"
+            "Found image with offset %#x, size %d, type %s, OS %s",
+            image.offset,
+            image.size,
+            str(image.type),
+            str(image.os),
+        )
+        if image.offset > largest_offset:
+            largest_offset = image.offset
+            offset_size = image.size
+        if image.type == "firmware" and image.os == "u-boot":
+            uboot_image_found = True
     if not uboot_image_found:
         raise InvalidUBootImage(
             "No U-Boot firmware sub-image contained within FIT image."
@@ -331,6 +939,93 @@ def get_u_boot_fit_size(
     return align_up(fdt_len, 4) + align_up(extra_len, 4)
 
 
+#: The size of the chunks firmware images are read in when hashing them.
+HASH_CHUNK_SIZE = 64 * 1024
+
+#: The largest firmware image that will be hashed. The largest images are U-Boot
+#: FIT images, which are normally under 1 MiB, so anything larger than this is
+#: assumed to be from a corrupt header.
+MAX_IMAGE_SIZE = 16 * 1024 * 1024
+
+
+def hash_range(
+    path: os.PathLike,
+    offset: int,
+    size: int,
+    chunk_size: int = HASH_CHUNK_SIZE,
+    max_size: int = MAX_IMAGE_SIZE,
+) -> hashlib._Hash:
+    """Compute the SHA256 of a range of bytes in a file or device.
+
+    The data is read in `chunk_size` pieces into a single reused buffer, so
+    memory usage does not depend on `size`. If `size` is larger than `max_size`,
+    or the file ends before `size` bytes have been read, `InvalidFirmwareImage`
+    is raised.
+    """
+    if size > max_size:
+        raise InvalidFirmwareImage(
+            f"Refusing to hash {size} bytes at {offset:#x} of {path} (the "
+            f"limit is {max_size} bytes)"
+        )
+    hasher = hashlib.sha256()
+    buf = bytearray(min(chunk_size, size))
+    view = memoryview(buf)
+    remaining = size
+    with open(path, "rb", buffering=0) as device:
+        device.seek(offset)
+        while remaining > 0:
+            read_len = device.readinto(view[:min(remaining, len(buf))])
+            profiler.count("reads")
+            profiler.count("bytes_read", read_len)
+            if not read_len:
+                raise InvalidFirmwareImage(
+                    f"{path} ended {remaining} bytes before the end of the "
+                    f"image at {offset:#x}"
+                )
+            hasher.update(view[:read_len])
+            remaining -= read_len
+    return hasher
+
+
+def ranges_equal(
+    first_path: os.PathLike,
+    first_offset: int,
+    second_path: os.PathLike,
+    second_offset: int,
+    size: int,
+    chunk_size: int = HASH_CHUNK_SIZE,
+) -> bool:
+    """Compare two ranges of bytes, each in a file or device.
+
+    The ranges are read in `chunk_size` pieces, and the comparison stops at the
+    first chunk that differs. If either file ends before `size` bytes have been
+    read, `InvalidFirmwareImage` is raised.
+    """
+    first_buf = bytearray(min(chunk_size, size))
+    second_buf = bytearray(len(first_buf))
+    first_view = memoryview(first_buf)
+    second_view = memoryview(second_buf)
+    remaining = size
+    with open(first_path, "rb") as first, open(second_path, "rb") as second:
+        first.seek(first_offset)
+        second.seek(second_offset)
+        while remaining > 0:
+            read_len = min(remaining, len(first_buf))
+            # Using buffered files so that readinto() fills the entire view
+            # unless the end of the file is reached.
+            for stream, view in ((first, first_view), (second, second_view)):
+                if stream.readinto(view[:read_len]) != read_len:
+                    raise InvalidFirmwareImage(
+                        f"{stream.name} ended before the end of the image"
+                    )
+                profiler.count("reads")
+                profiler.count("bytes_read", read_len)
+            if first_view[:read_len] != second_view[:read_len]:
+                return False
+            remaining -= read_len
+    return True
+
+
 @functools.total_ordering
 class ImageKind(enum.Enum):
 
@@ -352,7 +1047,22 @@ class ImageKind(enum.Enum):
 
 
 class FirmwareImage(object):
-    """A combination of device, offset, image type, and image size."""
+    """A combination of device, offset, image type, and image size.
+
+    Images are immutable and hashable. Two images are equal when they are the
+    same kind and byte range on the same device; use `same_data` to compare
+    what is in them.
+    """
+
+    __slots__ = (
+        "device",
+        "offset",
+        "kind",
+        "size",
+        "end",
+        "_hexdigest",
+        "_digest_lock",
+    )
 
     #: The device name or this image was found on, or a path to a bootloader
     #: image file.
@@ -367,62 +1077,76 @@ class FirmwareImage(object):
     #: The size of the image.
     size: int
 
-    @typing.overload
+    #: The offset just past the end of the image (`offset` + `size`).
+    end: int
+
     def __init__(
         self,
         device: os.PathLike,
         offset: int,
         kind: ImageKind,
         size: int,
-    ): ...
-
-    @typing.overload
-    def __init__(
-        self,
-        device: os.PathLike,
-        kind: ImageKind,
-    ): ...
-
-    def __init__(self, *args, **kwargs):
+    ):
         """Represent a firmware image.
 
         The source data for an image can either be a discrete file on a
-        filesystem, or a range of bytes (defined as an offset and length) on a
-        raw block device.
+        filesystem (see `from_file`), or a range of bytes (defined as an offset
+        and length) on a raw block device.
         """
-        attr_names = ("device", "offset", "kind", "size")
-        if len(args) == 4:
-            for attr_name, arg in zip(attr_names, args):
-                setattr(self, attr_name, arg)
-        elif kwargs.keys() == set(attr_names):
-            for attr_name in attr_names:
-                setattr(self, attr_name, kwargs[attr_name])
-        elif len(args) == 2:
-            self.device, self.kind = args
-            self.offset = 0
-            stat = os.stat(self.device)
-            self.size = stat.st_size
-        elif kwargs.keys() == {"device", "kind"}:
-            self.device = kwargs["device"]
-            self.kind = kwargs["kind"]
-            self.offset = 0
-            stat = os.stat(self.device)
-            self.size = stat.st_size
-        else:
-            raise ValueError()
+        if offset < 0:
+            raise ValueError(f"The offset ({offset}) must not be negative")
+        # Going around __setattr__, as that's blocked to keep this immutable
+        object.__setattr__(self, "device", device)
+        object.__setattr__(self, "offset", offset)
+        object.__setattr__(self, "kind", kind)
+        object.__setattr__(self, "size", size)
+        object.__setattr__(self, "end", offset + size)
+        object.__setattr__(self, "_hexdigest", None)
+        # Images may be hashed in the background while also being compared
+        object.__setattr__(self, "_digest_lock", threading.Lock())
+
+    @classmethod
+    def from_file(cls, path: os.PathLike, kind: ImageKind) -> FirmwareImage:
+        """Represent an entire file as a firmware image."""
+        return cls(path, 0, kind, os.stat(path).st_size)
+
+    def __setattr__(self, name: str, value: typing.Any):
+        raise AttributeError(f"{self.__class__.__name__} is immutable")
+
+    def __delattr__(self, name: str):
+        raise AttributeError(f"{self.__class__.__name__} is immutable")
 
-    @functools.cached_property
+    @property
     def hexdigest(self) -> str:
         """A secure hash of the data for this firmware image.
 
-        Currently this is the SHA256 of the data.
+        Currently this is the SHA256 of the data. The data is hashed in chunks
+        (see `hash_range`), so the image is never fully loaded into memory. The
+        hash is only calculated the first time it's needed (see
+        `compute_digest`).
         """
-        with open(self.device, "rb") as device:
-            device.seek(self.offset)
-            hasher = hashlib.sha256(
-                device.read(self.size)
-            )
-        return hasher.hexdigest()
+        if self._hexdigest is not None:
+            return self._hexdigest
+        return self.compute_digest()
+
+    def compute_digest(self) -> str:
+        """Calculate `hexdigest`, if it hasn't been already, and return it.
+
+        This can be called from several threads at once (for example, to hash
+        an image in the background). The data is only hashed once, and the
+        other threads wait for the result.
+        """
+        with self._digest_lock:
+            if self._hexdigest is None:
+                with profiler.phase("hexdigest", self.device):
+                    hasher = hash_range(self.device, self.offset, self.size)
+                object.__setattr__(self, "_hexdigest", hasher.hexdigest())
+            return self._hexdigest
+
+    @property
+    def has_hexdigest(self) -> bool:
+        """If `hexdigest` has already been calculated."""
+        return self._hexdigest is not None
 
     @property
     def path(self):
@@ -433,75 +1157,60 @@ class FirmwareImage(object):
         """
         return self.device
 
-    def __eq__(self, other: FirmwareImage) -> bool:
-        """Compare a firmware image to another firmware image.
+    def rebase(
+        self,
+        offset: int,
+        device: typing.Optional[os.PathLike] = None,
+    ) -> FirmwareImage:
+        """Return the range this image would have at a different offset.
+
+        If `device` is given, the new image is on that device instead. This is
+        used to see where an image would end up if it were written somewhere,
+        so the new image does not share the digest of this one.
+        """
+        return type(self)(
+            self.device if device is None else device,
+            offset,
+            self.kind,
+            self.size,
+        )
+
+    def overlaps(self, other: FirmwareImage) -> bool:
+        """Check if the byte ranges of two images overlap.
 
-        Only the `hexdigest` of both objects are compared.
+        Only the ranges are compared, not the devices.
         """
-        if isinstance(other, FirmwareImage):
+        return self.offset < other.end and other.offset < self.end
+
+    def same_data(self, other: FirmwareImage) -> bool:
+        """Compare the data of this image to another firmware image.
+
+        Images of different sizes never have the same data. If both images have
+        already been hashed, the `hexdigest` values are compared, otherwise the
+        data is compared directly (which stops at the first difference).
+        """
+        if self.size != other.size:
+            return False
+        if self.has_hexdigest and other.has_hexdigest:
             return self.hexdigest == other.hexdigest
-        else:
-            return NotImplemented
+        return ranges_equal(
+            self.device,
+            self.offset,
+            other.device,
+            other.offset,
+            self.size,
+        )
 
-    def __lt__(
-        self,
-        other: typing.Union[FirmwareImage, int]
-    ) -> bool:
-        if isinstance(other, FirmwareImage):
-            return self.offset + self.size < other.offset
-        elif isinstance(other, int):
-            return self.offset + self.size < other
-        else:
-            return NotImplemented
+    def _identity(self) -> typing.Tuple[typing.Any, ...]:
+        return (self.device, self.offset, self.kind, self.size)
 
-    def __le__(
-        self,
-        other: typing.Union[FirmwareImage, int]
-    ) -> bool:
-        if isinstance(other, FirmwareImage):
-            return self.offset + self.size <= other.offset
-        elif isinstance(other, int):
-            return self.offset + self.size <= other
-        else:
+    def __eq__(self, other: FirmwareImage) -> bool:
+        if not isinstance(other, FirmwareImage):
             return NotImplemented
+        return self._identity() == other._identity()
 
-    def __gt__(
-        self,
-        other: typing.Union[FirmwareImage, int]
-    ) -> bool:
-        if isinstance(other, FirmwareImage):
-            return self.offset + self.size > other.offset
-        elif isinstance(other, int):
-            return self.offset + self.size > other
-        else:
-            return NotImplemented
-
-    def __ge__(
-        self,
-        other: typing.Union[FirmwareImage, int]
-    ) -> bool:
-        if isinstance(other, FirmwareImage):
-            return self.offset + self.size >= other.offset
-        elif isinstance(other, int):
-            return self.offset + self.size >= other
-        else:
-            return NotImplemented
-
-    def __matmul__(
-        self,
-        new_offset: typing.Union[int, FirmwareImage]
-    ) -> FirmwareImage:
-        """Return a copy of this object, but with a different `offset`."""
-        if isinstance(new_offset, int):
-            if new_offset < 0:
-                raise ValueError(
-                    f"The new offset ({new_offset}) must be greater than 0"
-                )
-        elif isinstance(new_offset, FirmwareImage):
-            new_offset = new_offset.offset
-        else:
-            return NotImplemented
-        return type(self)(self.device, new_offset, self.kind, self.size)
+    def __hash__(self) -> int:
+        return hash(self._identity())
 
     def __repr__(self):
         # defining repr so that the size and offset are in hex
@@ -511,106 +1220,728 @@ class FirmwareImage(object):
         )
 
 
-# Copy the FirmwareImage overlap docstring to the ordering dunder methods
-_firmware_image_comparison_docstring = \
-"""Compare the byte range of an image to an offset.
+class IntervalIndex(object):
+    """A sorted collection of byte ranges, for finding which ones overlap.
+
+    Each half-open range (`start` to `end`) has a value, like the
+    `FirmwareImage` it came from. The ranges are kept sorted by their start,
+    along with the length of the longest range, so a query only looks at the
+    ranges that could overlap it. `end` may be `math.inf` for a range that
+    covers the rest of a device (like a partition), at the cost of queries
+    looking at every range before it.
+    """
 
-When ``other`` is an integer, the sum of ``self.offset`` and
-``self.size`` is compared against ``other``. When ``other`` is another
-`FirmwareImage`, the `offset` is taken, and then the comparison is done
-as if an integer was given.
+    __slots__ = ("_starts", "_entries", "_max_length")
 
-The intention is for this operation to be used to see if an image would
-overlap aither another image, or a given offset.
-"""
-for method_name in ("__lt__", "__le__", "__gt__", "__ge__"):
-    method = getattr(FirmwareImage, method_name)
-    method.__doc__ = _firmware_image_comparison_docstring
+    def __init__(
+        self,
+        ranges: typing.Iterable[typing.Tuple[int, float, typing.Any]] = (),
+    ):
+        self._starts: typing.List[int] = []
+        self._entries: typing.List[typing.Tuple[int, float, typing.Any]] = []
+        self._max_length = 0
+        for start, end, value in ranges:
+            self.add(start, end, value)
+
+    @classmethod
+    def from_images(
+        cls,
+        images: typing.Iterable[FirmwareImage],
+    ) -> IntervalIndex:
+        """Index the ranges of some images, with the images as the values."""
+        return cls((image.offset, image.end, image) for image in images)
+
+    def add(self, start: int, end: float, value: typing.Any):
+        """Add a range."""
+        import bisect
+
+        if end < start:
+            raise ValueError(f"Range ends ({end}) before it starts ({start})")
+        index = bisect.bisect_right(self._starts, start)
+        self._starts.insert(index, start)
+        self._entries.insert(index, (start, end, value))
+        self._max_length = max(self._max_length, end - start)
+
+    def overlapping(self, start: int, end: float) -> typing.List[typing.Any]:
+        """Return the values of the ranges overlapping a range, in order."""
+        import bisect
+
+        # Nothing starting this far back can reach `start`
+        first = bisect.bisect_right(self._starts, start - self._max_length)
+        last = bisect.bisect_left(self._starts, end)
+        return [
+            value
+            for entry_start, entry_end, value in self._entries[first:last]
+            if entry_start < end and start < entry_end
+        ]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+#: The functions that check for each kind of image, in the order they're tried.
+IMAGE_FINDERS = (
+    get_mlo_toc_size,
+    get_u_boot_legacy_size,
+    get_u_boot_fit_size,
+)
 
+#: The most of the start of a device that is read when scanning for images.
+#: Partitions usually start at 1, 4 or 8 MiB.
+MAX_SCAN_REGION_SIZE = 16 * 1024 * 1024
 
-def find_images(device_path: os.PathLike) -> typing.Collection[FirmwareImage]:
-    """Find firmware images on a raw block device."""
+#: Signatures for finding possible images when scanning a region. Each entry is
+#: the 4 bytes to look for, their offset from the start of an image, and the
+#: function to then check the image with.
+SCAN_SIGNATURES = (
+    # The "CHSETTINGS" file name in the MLO TOC
+    (b"CHSE", 0x14, get_mlo_toc_size),
+    (struct.pack(">I", 0x27051956), 0, get_u_boot_legacy_size),
+    (struct.pack(">I", FDT_MAGIC), 0, get_u_boot_fit_size),
+)
+
+
+def scan_region(
+    region: memoryview,
+    sector_size: int = DEFAULT_SECTOR_SIZE,
+) -> typing.Sequence[typing.Tuple[int, typing.Callable[[io.BinaryIO], int]]]:
+    """Find the sector-aligned offsets in `region` that might have an image.
+
+    Instead of trying every image finder at every sector, only the signature
+    words in `SCAN_SIGNATURES` are checked. For each signature, a strided view
+    over `region` picks out the word at that position in every sector, and
+    those words are searched in one go. The offsets found are returned in
+    order, each with the function that will check the image there.
+    """
+    sector_count = len(region) // sector_size
+    # Casting to 4-byte words means the search is done on one integer per
+    # sector, and does not need to copy `region`.
+    words = region[:sector_count * sector_size].cast("I")
+    words_per_sector = sector_size // words.itemsize
+    candidates = []
+    for signature, signature_offset, get_size in SCAN_SIGNATURES:
+        # The words are in native byte order, so unpack the signature the same
+        # way.
+        (signature_word,) = struct.unpack("=I", signature)
+        first_word = signature_offset // words.itemsize
+        column = words[first_word::words_per_sector].tolist()
+        sector = -1
+        while True:
+            try:
+                sector = column.index(signature_word, sector + 1)
+            except ValueError:
+                break
+            candidates.append((sector * sector_size, get_size))
+    candidates.sort(key=lambda c: (c[0], IMAGE_FINDERS.index(c[1])))
+    log.debug(
+        "Found %d possible images in %d sectors",
+        len(candidates),
+        sector_count,
+    )
+    return candidates
+
+
+def find_images(
+    device_path: os.PathLike,
+    region: typing.Optional[memoryview] = None,
+    scan: bool = False,
+    sector_size: int = DEFAULT_SECTOR_SIZE,
+) -> typing.Collection[FirmwareImage]:
+    """Find firmware images on a raw block device.
+
+    If `region` is given, it is used as the contents of the start of the device
+    instead of reading it from the device (see `read_boot_region`).
+
+    Normally only the offsets in `RAW_BOOT_OFFSETS` are checked. If `scan` is
+    `True`, every sector of `region` (with a size of `sector_size`) is checked
+    instead (see `scan_region`). Scanning only finds images within `region`,
+    so it should cover everything before the first partition. When scanning,
+    anything found inside of an earlier image (like a device tree embedded in
+    U-Boot) is ignored.
+    """
     images = []
-    image_finders = (
-        get_mlo_toc_size,
-        get_u_boot_legacy_size,
-        get_u_boot_fit_size
-    )
-    with open(device_path, "rb") as device:
-        for offset in (0, 0x20000, 0x40000, 0x60000):
-            for get_size in image_finders:
-                device.seek(offset)
-                try:
+    found = IntervalIndex()
+    if region is None:
+        region = read_boot_region(device_path)
+    if scan:
+        with profiler.phase("scan_region", device_path):
+            candidates = scan_region(region, sector_size)
+    else:
+        candidates = [
+            (offset, get_size)
+            for offset in RAW_BOOT_OFFSETS
+            if offset < len(region)
+            for get_size in IMAGE_FINDERS
+        ]
+    device = BufferReader(region, device_path)
+    with device:
+        for offset, get_size in candidates:
+            if scan:
+                containing_images = found.overlapping(offset, offset + 1)
+                if containing_images:
+                    log.debug(
+                        "Skipping possible image at %#x inside of %s",
+                        offset,
+                        containing_images[0],
+                    )
+                    continue
+            device.seek(offset)
+            try:
+                with profiler.phase(get_size.__name__, device_path):
                     image_size = get_size(device)
-                except InvalidFirmwareImage as exc:
-                    # Just log these exceptions, they're expected
-                    log.debug("%s", exc)
-                else:
-                    if get_size is get_mlo_toc_size:
-                        image_kind = ImageKind.MLO
-                    else:
-                        image_kind = ImageKind.UBOOT
-                    images.append(FirmwareImage(
-                        device_path,
+            except InvalidFirmwareImage as exc:
+                # Just log these exceptions, they're expected
+                log.debug("%s", exc)
+            else:
+                if image_size > MAX_IMAGE_SIZE:
+                    log.warning(
+                        "Ignoring image at %#x on %s with an implausible "
+                        "size of %d bytes",
                         offset,
-                        image_kind,
-                        image_size
-                    ))
+                        device_path,
+                        image_size,
+                    )
+                    continue
+                if get_size is get_mlo_toc_size:
+                    image_kind = ImageKind.MLO
+                else:
+                    image_kind = ImageKind.UBOOT
+                image = FirmwareImage(
+                    device_path,
+                    offset,
+                    image_kind,
+                    image_size
+                )
+                images.append(image)
+                found.add(image.offset, image.end, image)
     return images
 
 
-def compare_images(
+DEFAULT_DIGEST_CACHE_PATH = "/var/cache/cluster-netboot/am335x-digests.json"
+
+
+def get_device_id(device_path: os.PathLike) -> str:
+    """Return an identifier for the physical device at a path.
+
+    For MMC/SD devices the card's CID (or serial number) is used, so the
+    identifier follows the card instead of the device name. For anything else
+    the resolved path and inode are used.
+    """
+    real_path = os.path.realpath(device_path)
+    device_name = os.path.basename(real_path)
+    for attr_name in ("cid", "serial"):
+        attr_path = f"/sys/class/block/{device_name}/device/{attr_name}"
+        try:
+            with open(attr_path, "r") as attr_file:
+                value = attr_file.read().strip()
+        except OSError:
+            continue
+        if value:
+            return f"{attr_name}:{value}"
+    stat = os.stat(real_path)
+    return f"path:{real_path}:{stat.st_dev}:{stat.st_ino}"
+
+
+def read_sysfs_attr(path: str) -> typing.Optional[str]:
+    """Read a sysfs attribute, returning `None` if it's missing or empty."""
+    try:
+        with open(path, "r") as attr_file:
+            value = attr_file.read().strip()
+    except OSError:
+        return None
+    return value or None
+
+
+def get_media_id(device_path: os.PathLike) -> typing.Optional[str]:
+    """Return an identifier for the media at a path, that changes with it.
+
+    MMC/SD cards are identified by their CID (or serial number), as with
+    `get_device_id`. Other block devices (loop devices included) use their disk
+    sequence number, which changes whenever the media changes or a new image is
+    attached, along with the boot ID as the sequence numbers restart on every
+    boot. Disk image files use their inode and modification time.
+
+    Returns:
+        `None` if there's nothing that is sure to change along with the media.
+    """
+    real_path = os.path.realpath(device_path)
+    device_name = os.path.basename(real_path)
+    for attr_name in ("cid", "serial"):
+        value = read_sysfs_attr(
+            f"/sys/class/block/{device_name}/device/{attr_name}"
+        )
+        if value is not None:
+            return f"{attr_name}:{value}"
+    device_stat = os.stat(real_path)
+    if stat.S_ISREG(device_stat.st_mode):
+        return (
+            f"file:{real_path}:{device_stat.st_dev}:{device_stat.st_ino}:"
+            f"{device_stat.st_size}:{device_stat.st_mtime_ns}"
+        )
+    diskseq = read_sysfs_attr(f"/sys/class/block/{device_name}/diskseq")
+    boot_id = read_sysfs_attr("/proc/sys/kernel/random/boot_id")
+    if diskseq is not None and boot_id is not None:
+        return f"diskseq:{boot_id}:{diskseq}"
+    return None
+
+
+#: How many sectors from the middle of an image are included in its fingerprint
+#: (see `DigestCache.fingerprint`), spread evenly between the header and end.
+FINGERPRINT_MIDDLE_SECTORS = 8
+
+
+class DigestCache(object):
+    """A persistent cache of the digests of on-device firmware images.
+
+    Entries are keyed by the media identity (see `get_media_id`), offset, size,
+    and kind of image; devices without a media identity aren't cached. Each
+    entry also stores a fingerprint (a hash of a sample of the image's
+    sectors), and a cached digest is only used if the fingerprint still matches
+    what is on the device.
+    """
+
+    #: The path of the cache file.
+    path: os.PathLike
+
+    #: If `True`, cached digests are never used, but the cache is still updated.
+    force_verify: bool
+
+    def __init__(
+        self,
+        path: os.PathLike = DEFAULT_DIGEST_CACHE_PATH,
+        force_verify: bool = False,
+    ):
+        import json
+
+        self.path = path
+        self.force_verify = force_verify
+        self._entries: typing.Dict[str, typing.Dict[str, str]] = {}
+        self._dirty = False
+        # The cache is shared between the threads checking each device
+        self._lock = threading.Lock()
+        try:
+            with open(self.path, "r") as cache_file:
+                entries = json.load(cache_file)
+        except FileNotFoundError:
+            log.debug("No digest cache at %s", self.path)
+        except (OSError, ValueError) as exc:
+            log.warning(
+                "Ignoring unreadable digest cache %s: %s",
+                self.path,
+                exc,
+            )
+        else:
+            if isinstance(entries, dict):
+                self._entries = entries
+
+    def _key(self, image: FirmwareImage) -> typing.Optional[str]:
+        # Not remembered, as the media can change while the daemon is running
+        media_id = get_media_id(image.device)
+        if media_id is None:
+            return None
+        return (
+            f"{media_id}|{image.offset:#x}|{image.size:#x}|{image.kind.name}"
+        )
+
+    @staticmethod
+    def fingerprint(image: FirmwareImage) -> str:
+        """Hash a sample of the sectors of an image.
+
+        The first two sectors are included (for an MLO, the first is the
+        constant TOC and the second has the GP header with the size and load
+        address), then `FINGERPRINT_MIDDLE_SECTORS` sectors spread through the
+        middle, and the last sector.
+        """
+        sector_len = min(DEFAULT_SECTOR_SIZE, image.size)
+        last_offset = image.size - sector_len
+        offsets = {0, min(sector_len, last_offset), last_offset}
+        for index in range(1, FINGERPRINT_MIDDLE_SECTORS + 1):
+            offsets.add(
+                last_offset * index // (FINGERPRINT_MIDDLE_SECTORS + 1)
+            )
+        hasher = hashlib.sha256(struct.pack("<Q", image.size))
+        with profiler.phase("fingerprint", image.device):
+            fd = os.open(image.device, os.O_RDONLY)
+            try:
+                for offset in sorted(offsets):
+                    hasher.update(
+                        os.pread(fd, sector_len, image.offset + offset)
+                    )
+            finally:
+                os.close(fd)
+            profiler.count("reads", len(offsets))
+            profiler.count("bytes_read", len(offsets) * sector_len)
+        return hasher.hexdigest()
+
+    def lookup(self, image: FirmwareImage) -> typing.Optional[str]:
+        """Return the cached digest for an image, if there is a valid one."""
+        if self.force_verify:
+            return None
+        key = self._key(image)
+        if key is None:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.get("fingerprint") != self.fingerprint(image):
+            log.debug("Cached digest for %s is stale", image)
+            return None
+        log.debug("Using cached digest for %s", image)
+        return entry.get("sha256")
+
+    def store(self, image: FirmwareImage, hexdigest: str):
+        """Record the digest of an image."""
+        key = self._key(image)
+        if key is None:
+            return
+        entry = {
+            "fingerprint": self.fingerprint(image),
+            "sha256": hexdigest,
+        }
+        with self._lock:
+            self._entries[key] = entry
+            self._dirty = True
+
+    def invalidate(self, device_path: os.PathLike, offset: int, size: int):
+        """Remove any entries for images overlapping a range on a device."""
+        media_id = get_media_id(device_path)
+        if media_id is None:
+            return
+        end = offset + size
+        with self._lock:
+            for key in list(self._entries.keys()):
+                entry_media_id, entry_offset, entry_size, _ = key.rsplit(
+                    "|", 3
+                )
+                if entry_media_id != media_id:
+                    continue
+                entry_start = int(entry_offset, 16)
+                entry_end = entry_start + int(entry_size, 16)
+                if entry_start < end and offset < entry_end:
+                    log.debug("Invalidating cached digest %s", key)
+                    del self._entries[key]
+                    self._dirty = True
+
+    @staticmethod
+    def _is_expired(media_id: str) -> bool:
+        """Check if entries for a media identity can never be used again."""
+        kind, _, value = media_id.partition(":")
+        if kind == "file":
+            # Rewritten disk images get a new identity each time
+            path = value.rsplit(":", 4)[0]
+            try:
+                return get_media_id(path) != media_id
+            except OSError:
+                return True
+        if kind == "diskseq":
+            boot_id = value.partition(":")[0]
+            return boot_id != read_sysfs_attr("/proc/sys/kernel/random/boot_id")
+        return False
+
+    def save(self):
+        """Write the cache back to disk (if it has changed).
+
+        Entries that can no longer be used (for rewritten disk images, or for
+        disk sequence numbers from an earlier boot) are dropped. Failures are
+        logged, but otherwise ignored as the cache is only an optimization.
+        """
+        import json
+
+        if not self._dirty:
+            return
+        temp_path = f"{self.path}.tmp"
+        with self._lock:
+            expired = {}
+            for key in list(self._entries.keys()):
+                media_id = key.rsplit("|", 3)[0]
+                if media_id not in expired:
+                    expired[media_id] = self._is_expired(media_id)
+                if expired[media_id]:
+                    del self._entries[key]
+        try:
+            cache_dir = os.path.dirname(self.path)
+            if cache_dir:
+                os.makedirs(cache_dir, exist_ok=True)
+            with open(temp_path, "w") as cache_file:
+                json.dump(self._entries, cache_file, indent=1, sort_keys=True)
+            os.replace(temp_path, self.path)
+        except OSError as exc:
+            log.warning("Unable to save digest cache %s: %s", self.path, exc)
+        else:
+            self._dirty = False
+
+
+class ImageReport(object):
+    """What was found (and done) for one firmware image on a device."""
+
+    #: The image found on the device.
+    image: FirmwareImage
+
+    #: If the image is outdated, or `None` if it couldn't be compared.
+    outdated: typing.Optional[bool]
+
+    #: What was done with the image. One of "none" (the image is current),
+    #: "would-update" (for dry runs), "skipped" (declined interactively),
+    #: "updated", or "error".
+    action: str
+
+    #: How many bytes were written when updating the image.
+    bytes_written: int
+
+    #: The SHA256 of the image on the device (before any update), if known.
+    digest: typing.Optional[str]
+
+    def __init__(self, image: FirmwareImage):
+        self.image = image
+        self.outdated = None
+        self.action = "error"
+        self.bytes_written = 0
+        self.digest = None
+
+    def to_json(self) -> typing.Dict[str, typing.Any]:
+        return {
+            "kind": self.image.kind.name,
+            "offset": self.image.offset,
+            "size": self.image.size,
+            "digest": self.digest,
+            "outdated": self.outdated,
+            "action": self.action,
+            "bytes_written": self.bytes_written,
+        }
+
+
+class DeviceReport(object):
+    """What was found (and done) on one device, for machine-readable output."""
+
+    #: The device path.
+    device: os.PathLike
+
+    #: The offset of the first partition, or `None` if there is no partition
+    #: table.
+    first_partition_offset: typing.Optional[int]
+
+    #: Every firmware image found on the device.
+    images: typing.List[ImageReport]
+
+    #: How long (in seconds) each phase ("scan", "compare", "write", "fsync",
+    #: "verify") took for this device.
+    timings: typing.Dict[str, float]
+
+    #: If the device could not be checked (or updated), the reason why. Only
+    #: used in fleet mode, where one device failing doesn't stop the others.
+    error: typing.Optional[str]
+
+    def __init__(self, device: os.PathLike):
+        self.device = device
+        self.first_partition_offset = None
+        self.images = []
+        self.timings = {}
+        self.error = None
+
+    def add_timing(self, phase: str, start_time: float):
+        """Add the time since `start_time` to a phase."""
+        elapsed = time.monotonic() - start_time
+        self.timings[phase] = self.timings.get(phase, 0.0) + elapsed
+
+    def find_image(self, image: FirmwareImage) -> typing.Optional[ImageReport]:
+        """Find the report for an image (by its offset)."""
+        for image_report in self.images:
+            if image_report.image.offset == image.offset:
+                return image_report
+        return None
+
+    def to_json(self) -> typing.Dict[str, typing.Any]:
+        return {
+            "device": os.fsdecode(self.device),
+            "first_partition_offset": self.first_partition_offset,
+            "images": [image.to_json() for image in self.images],
+            "bytes_written": sum(image.bytes_written for image in self.images),
+            "timings": self.timings,
+            "error": self.error,
+        }
+
+
+class DeviceScan(typing.NamedTuple):
+    """The firmware images found on a device, before being compared."""
+
+    #: The device path.
+    device: os.PathLike
+
+    #: The offset of the first partition, or `None` if there is no partition
+    #: table (in which case no images are looked for).
+    first_partition_offset: typing.Optional[int]
+
+    #: The firmware images found before the first partition.
+    images: typing.Sequence[FirmwareImage]
+
+
+def scan_device(
+    device_path: os.PathLike,
+    report: typing.Optional[DeviceReport] = None,
+    scan: bool = False,
+) -> DeviceScan:
+    """Find the partition table and firmware images on a device.
+
+    This doesn't need the source images, so it can be done while they're still
+    being checked. If `report` is given, the first partition and time taken are
+    added to it. If `scan` is `True`, everything before the first partition (up
+    to `MAX_SCAN_REGION_SIZE`) is scanned for images, instead of only checking
+    the usual offsets.
+    """
+    start_time = time.monotonic()
+    with profiler.phase("get_block_size", device_path):
+        sector_size = get_block_size(device_path)
+    log.debug("Using %d-byte sectors for %s", sector_size, device_path)
+    # Read the entire boot region once, and then have the partition parser and
+    # image finders work on that buffer instead of the device.
+    with profiler.phase("read_boot_region", device_path):
+        region = read_boot_region(
+            device_path,
+            align_up(BOOT_REGION_SIZE, sector_size),
+        )
+    with BufferReader(region, device_path) as device:
+        with profiler.phase("find_first_partition", device_path):
+            lowest_partition_start = find_first_partition(
+                device, sector_size
+            )
+        # Without a partition table there's no way to tell how much space is
+        # free for the bootloaders, so just skip the device.
+        if lowest_partition_start is None:
+            log.info(
+                "No partitions found on device '%s', skipping.",
+                device_path
+            )
+            if report is not None:
+                report.add_timing("scan", start_time)
+            return DeviceScan(device_path, None, [])
+    if scan and len(region) < lowest_partition_start:
+        scan_length = min(lowest_partition_start, MAX_SCAN_REGION_SIZE)
+        if scan_length < lowest_partition_start:
+            log.warning(
+                "Only scanning the first %d bytes of %s for images (the first "
+                "partition starts at %#x)",
+                scan_length,
+                device_path,
+                lowest_partition_start,
+            )
+        # Still one read, just a bigger one (the start of the device will
+        # already be in the page cache).
+        with profiler.phase("read_boot_region", device_path):
+            region = read_boot_region(
+                device_path,
+                align_up(scan_length, sector_size),
+            )
+    # Nothing past the start of the first partition can be a boot image.
+    images = find_images(
+        device_path,
+        region[:lowest_partition_start],
+        scan,
+        sector_size,
+    )
+    if report is not None:
+        report.first_partition_offset = lowest_partition_start
+        report.add_timing("scan", start_time)
+    if not images:
+        log.debug("No firmware images found on device '%s'", device_path)
+    return DeviceScan(device_path, lowest_partition_start, images)
+
+
+def compare_scanned_images(
     new_mlo: FirmwareImage,
     new_u_boot: FirmwareImage,
-    device_paths: typing.Iterable[os.PathLike],
+    device_scan: DeviceScan,
+    digest_cache: typing.Optional[DigestCache] = None,
+    report: typing.Optional[DeviceReport] = None,
 ) -> typing.Sequence[FirmwareImage]:
-    """Update BeagleBone Black/Green firmware.
+    """Find the outdated firmware images from a `scan_device` result.
 
-    This handles both raw and FAT bootloader configurations (see section
-    26.1.8.5 of the AM335x Reference Manual for more details).
+    If `report` is given, it is filled in with the images found on the device.
+    Reports include the digest of every image, so outdated images are hashed
+    when a report is requested.
     """
-    # There are two possible MMC/SD devices on BeagleBones, mmcblk0 and 1, and
-    # four possible locations for the MLO: 0, 0x20000, 0x40000, and 0x60000.
-    # The full U-Boot image is then (possibly) at one of the later loader
-    # locations.
     images_to_update = []
-    for device_path in device_paths:
-        sector_size = get_block_size(device_path)
-        log.debug("Using %d-byte sectors for %s", sector_size, device_path)
-        with open(device_path, "rb") as device:
-            lowest_partition_start = find_mbr_first_partition(
-                device, sector_size
-            )
-            # Just not handling the case where there's no MBR
-            if lowest_partition_start is None:
-                log.info(
-                    "No MBR found on device '%s', skipping.",
-                    device_path
-                )
-                continue
-        images = find_images(device_path)
-        if not images:
-            log.debug("No firmware images found on device '%s'", device_path)
+    device_path = device_scan.device
+    lowest_partition_start = device_scan.first_partition_offset
+    images = device_scan.images
+    start_time = time.monotonic()
+    # What the new images have to stay clear of. The first partition is given
+    # a value of `None`.
+    occupied = IntervalIndex.from_images(images)
+    if lowest_partition_start is not None:
+        occupied.add(lowest_partition_start, math.inf, None)
+    with profiler.phase("compare", device_path):
         for image in images:
+            image_report = ImageReport(image)
+            if report is not None:
+                report.images.append(image_report)
             if image.offset == 0:
                 # This error should not be hit
                 log.error("%s would overlap the MBR", image)
                 continue
-            # "shift" the new image to the offset of the old image
             if image.kind is ImageKind.MLO:
                 new_image = new_mlo
             elif image.kind is ImageKind.UBOOT:
                 new_image = new_u_boot
             else:
                 raise ValueError("Unknown image kind %s", image.kind)
-            if new_image @ image >= lowest_partition_start:
+            # "shift" the new image to the offset of the old image
+            target = new_image.rebase(image.offset, device_path)
+            conflicts = [
+                other
+                for other in occupied.overlapping(target.offset, target.end)
+                if other is not image
+            ]
+            if None in conflicts:
                 log.error(
                     "%s would overlap the partition starting at %#x",
-                    image
+                    image,
+                    lowest_partition_start,
+                )
+                continue
+            elif conflicts:
+                log.error(
+                    "New %s (%s) would overlap %s if written over %s",
+                    image.kind.value,
+                    new_image.path,
+                    ", ".join(map(repr, conflicts)),
+                    image,
                 )
                 continue
-            # The equality operation *only* checks the sha256 hash of the data
-            if new_image != image:
+            try:
+                cached_digest = None
+                if digest_cache is not None:
+                    cached_digest = digest_cache.lookup(image)
+                if cached_digest is not None:
+                    is_outdated = (
+                        new_image.size != image.size
+                        or new_image.hexdigest != cached_digest
+                    )
+                else:
+                    # The equality operation *only* checks the data
+                    is_outdated = not new_image.same_data(image)
+                    if digest_cache is not None and not is_outdated:
+                        # The images are the same, so the digest of the new
+                        # image is also the digest of the existing image.
+                        digest_cache.store(image, new_image.hexdigest)
+                    elif (
+                        digest_cache is not None
+                        and image.has_hexdigest
+                    ):
+                        digest_cache.store(image, image.hexdigest)
+                image_report.outdated = is_outdated
+                if report is not None:
+                    if cached_digest is not None:
+                        image_report.digest = cached_digest
+                    elif not is_outdated:
+                        image_report.digest = new_image.hexdigest
+                    else:
+                        image_report.digest = image.hexdigest
+            except (InvalidFirmwareImage, OSError) as exc:
+                log.error("Unable to read %s: %s", image, exc)
+                continue
+            image_report.action = "none"
+            if is_outdated:
                 log.info(
                     (
                         "New %(kind)s (%(path)s) does not match existing "
@@ -623,47 +1954,793 @@ def compare_images(
                         "offset": image.offset,
                     }
                 )
-                log.debug(
-                    "%-20s: %s",
-                    "New image hash",
-                    new_image.hexdigest
-                )
-                log.debug(
-                    "%-20s: %s",
-                    "Existing image hash",
-                    image.hexdigest
-                )
+                # Only hash the images if the hashes are going to be logged
+                if log.isEnabledFor(logging.DEBUG):
+                    log.debug(
+                        "%-20s: %s",
+                        "New image hash",
+                        new_image.hexdigest
+                    )
+                    log.debug(
+                        "%-20s: %s",
+                        "Existing image hash",
+                        image.hexdigest
+                    )
                 images_to_update.append(image)
+    if report is not None:
+        report.add_timing("compare", start_time)
     return images_to_update
 
 
-def copy_raw(
+def compare_device_images(
+    new_mlo: FirmwareImage,
+    new_u_boot: FirmwareImage,
+    device_path: os.PathLike,
+    digest_cache: typing.Optional[DigestCache] = None,
+    report: typing.Optional[DeviceReport] = None,
+    scan: bool = False,
+) -> typing.Sequence[FirmwareImage]:
+    """Find the outdated firmware images on a single device.
+
+    This is the per-device part of `compare_images`, and is `scan_device`
+    followed by `compare_scanned_images`.
+    """
+    return compare_scanned_images(
+        new_mlo,
+        new_u_boot,
+        scan_device(device_path, report, scan),
+        digest_cache,
+        report,
+    )
+
+
+def compare_images(
+    new_mlo: FirmwareImage,
+    new_u_boot: FirmwareImage,
+    device_paths: typing.Iterable[os.PathLike],
+    digest_cache: typing.Optional[DigestCache] = None,
+    reports: typing.Optional[typing.Mapping[os.PathLike, DeviceReport]] = None,
+    scan: bool = False,
+) -> typing.Sequence[FirmwareImage]:
+    """Update BeagleBone Black/Green firmware.
+
+    This handles both raw and FAT bootloader configurations (see section
+    26.1.8.5 of the AM335x Reference Manual for more details).
+
+    Devices are checked concurrently, but the returned images are in the same
+    order as `device_paths`.
+
+    If `digest_cache` is given, cached digests of the images on the devices are
+    used instead of reading the entire image, and the cache is updated with any
+    images that had to be read. If `reports` is given, the report for each
+    device in it is filled in. If `scan` is `True`, all of the space before the
+    first partition is scanned for images (see `compare_device_images`).
+    """
+    import concurrent.futures
+
+    # There are two possible MMC/SD devices on BeagleBones, mmcblk0 and 1, and
+    # four possible locations for the MLO: 0, 0x20000, 0x40000, and 0x60000.
+    # The full U-Boot image is then (possibly) at one of the later loader
+    # locations.
+    # Each device is independent of the others, so they're checked in parallel.
+    # Most of the time is spent waiting on I/O or in hashlib, both of which
+    # release the GIL, so threads are enough.
+    device_paths = list(device_paths)
+    if not device_paths:
+        return []
+    if reports is None:
+        reports = {}
+
+    def compare_device(device_path):
+        return compare_device_images(
+            new_mlo,
+            new_u_boot,
+            device_path,
+            digest_cache,
+            reports.get(device_path),
+            scan,
+        )
+
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=len(device_paths)
+    ) as executor:
+        # map() returns results in the same order as device_paths, so the
+        # output does not depend on which device finishes first.
+        return list(itertools.chain.from_iterable(
+            executor.map(compare_device, device_paths)
+        ))
+
+
+#: The size of the chunks images are read (and compared) in when writing them.
+#: This is also the largest single write issued.
+WRITE_CHUNK_SIZE = 1024 * 1024
+
+
+def allocate_aligned_buffer(size: int) -> memoryview:
+    """Allocate a page-aligned buffer (as required for `O_DIRECT`)."""
+    import mmap
+
+    # Anonymous mmaps are always page-aligned
+    return memoryview(mmap.mmap(-1, size))
+
+
+def write_image(
+    fd: int,
     source_image: FirmwareImage,
-    target_image: FirmwareImage,
-):
-    """Copy the contents of one image over another image."""
+    target_offset: int,
+    block_size: int,
+    delta: bool = True,
+    chunk_size: int = WRITE_CHUNK_SIZE,
+) -> int:
+    """Write an image to an open device at a block-aligned offset.
+
+    Both the source image and the existing data on the device are read in
+    `chunk_size` pieces. If `delta` is `True`, only the `block_size` blocks
+    that differ are written, with runs of adjacent differing blocks combined
+    into one write. Writes are always whole blocks; if the image does not end
+    on a block boundary, the rest of the last block is filled in with the
+    existing data on the device. All buffers are page-aligned, so `fd` may have
+    been opened with `O_DIRECT`. The device is not synced; that is left to the
+    caller. The number of bytes written is returned.
+    """
+    # Keep whole blocks in each chunk so blocks never straddle two chunks
+    chunk_size = max(block_size, chunk_size - chunk_size % block_size)
+    source_view = allocate_aligned_buffer(chunk_size)
+    target_view = allocate_aligned_buffer(chunk_size)
+    bytes_written = 0
+
+    def write_run(start: int, end: int, chunk_start: int):
+        nonlocal bytes_written
+        write_offset = target_offset + chunk_start + start
+        run_written = 0
+        while start + run_written < end:
+            run_written += os.pwrite(
+                fd,
+                source_view[start + run_written:end],
+                write_offset + run_written,
+            )
+            profiler.count("writes")
+        bytes_written += run_written
+        profiler.count("bytes_written", run_written)
+        log.debug(
+            "Wrote %d bytes at %#x",
+            run_written,
+            write_offset,
+        )
+
     with open(source_image.device, "rb") as source:
         source.seek(source_image.offset)
-        fd = os.open(target_image.device, os.O_WRONLY)
+        for chunk_start in range(0, source_image.size, chunk_size):
+            read_len = min(chunk_size, source_image.size - chunk_start)
+            if source.readinto(source_view[:read_len]) != read_len:
+                raise InvalidFirmwareImage(
+                    f"{source_image.device} ended before the end of the image"
+                )
+            profiler.count("reads")
+            profiler.count("bytes_read", read_len)
+            chunk_len = align_up(read_len, block_size)
+            # The existing data is only needed to compare against, or to fill
+            # in the end of a partial last block.
+            if delta or chunk_len != read_len:
+                target_len = os.preadv(
+                    fd,
+                    [target_view[:chunk_len]],
+                    target_offset + chunk_start,
+                )
+                profiler.count("reads")
+                profiler.count("bytes_read", target_len)
+                # Anything past the end of the device is treated as zeros
+                target_view[target_len:chunk_len] = bytes(
+                    chunk_len - target_len
+                )
+                source_view[read_len:chunk_len] = (
+                    target_view[read_len:chunk_len]
+                )
+            if not delta:
+                write_run(0, chunk_len, chunk_start)
+                continue
+            run_start = None
+            for block_start in range(0, chunk_len, block_size):
+                block_end = block_start + block_size
+                if (
+                    source_view[block_start:block_end]
+                    == target_view[block_start:block_end]
+                ):
+                    if run_start is not None:
+                        write_run(run_start, block_start, chunk_start)
+                        run_start = None
+                elif run_start is None:
+                    run_start = block_start
+            if run_start is not None:
+                write_run(run_start, chunk_len, chunk_start)
+    return bytes_written
+
+
+def write_image_full(
+    fd: int,
+    source_image: FirmwareImage,
+    target_offset: int,
+) -> int:
+    """Write an entire image to an open device with `sendfile()`.
+
+    This works for any offset, but `fd` must not have been opened with
+    `O_DIRECT`. The device is not synced. The number of bytes written is
+    returned.
+    """
+    with open(source_image.device, "rb") as source:
+        os.lseek(fd, target_offset, os.SEEK_SET)
+        # And now we rely on sendfile() aligning things properly
+        write_size = os.sendfile(
+            fd,
+            source.fileno(),
+            source_image.offset,
+            source_image.size
+        )
+        assert write_size == source_image.size
+    profiler.count("writes")
+    profiler.count("bytes_written", write_size)
+    return write_size
+
+
+class WriteVerificationError(Exception):
+    """Raised when an image read back from a device does not match."""
+    pass
+
+
+def verify_image(
+    device_path: os.PathLike,
+    source_image: FirmwareImage,
+    target_offset: int,
+    block_size: int,
+    chunk_size: int = WRITE_CHUNK_SIZE,
+) -> bool:
+    """Check that an image on a device matches a source image.
+
+    The data is read from the device with `O_DIRECT`, so that it comes from
+    the media instead of the page cache (and doesn't fill the page cache on the
+    way). If `O_DIRECT` isn't supported for the device (or `target_offset` is
+    not block-aligned), the device's cached pages for the image are dropped with
+    `posix_fadvise()` before and after a normal read instead. The data is
+    compared to `source_image.hexdigest`.
+    """
+    read_start = target_offset - target_offset % block_size
+    read_end = align_up(target_offset + source_image.size, block_size)
+    chunk_size = max(block_size, chunk_size - chunk_size % block_size)
+    fd = None
+    if read_start == target_offset:
         try:
-            os.set_blocking(fd, True)
-            os.lseek(fd, target_image.offset, os.SEEK_SET)
-            # And now we rely on sendfile() aligning things properly
-            write_size = os.sendfile(
+            fd = os.open(device_path, os.O_RDONLY | os.O_DIRECT)
+        except OSError as exc:
+            log.debug("Unable to use O_DIRECT for %s: %s", device_path, exc)
+    use_fadvise = fd is None
+    if use_fadvise:
+        fd = os.open(device_path, os.O_RDONLY)
+    try:
+        if use_fadvise:
+            os.posix_fadvise(
                 fd,
-                source.fileno(),
-                None,
-                source_image.size
+                read_start,
+                read_end - read_start,
+                os.POSIX_FADV_DONTNEED,
             )
-            assert write_size == source_image.size
-        except OSError:
-            # reraise it immediately; this except-clause is to satisfy the
-            # grammar so we can have an else-clause
-            raise
-        else:
+        view = allocate_aligned_buffer(chunk_size)
+        hasher = hashlib.sha256()
+        for chunk_start in range(read_start, read_end, chunk_size):
+            chunk_len = min(chunk_size, read_end - chunk_start)
+            read_len = os.preadv(fd, [view[:chunk_len]], chunk_start)
+            profiler.count("reads")
+            profiler.count("bytes_read", read_len)
+            # Only hash the part of the blocks that is part of the image
+            hash_start = max(target_offset - chunk_start, 0)
+            hash_end = min(
+                target_offset + source_image.size - chunk_start,
+                read_len,
+            )
+            hasher.update(view[hash_start:hash_end])
+            if read_len != chunk_len:
+                break
+        if use_fadvise:
+            os.posix_fadvise(
+                fd,
+                read_start,
+                read_end - read_start,
+                os.POSIX_FADV_DONTNEED,
+            )
+    finally:
+        os.close(fd)
+    return hasher.hexdigest() == source_image.hexdigest
+
+
+class PendingWrite(typing.NamedTuple):
+    """A source image, and the existing image it is going to overwrite."""
+
+    source: FirmwareImage
+
+    target: FirmwareImage
+
+
+def write_image_staged(
+    fd: int,
+    source_image: FirmwareImage,
+    target_offset: int,
+    block_size: int,
+    delta: bool = True,
+    on_stage: typing.Optional[typing.Callable[[str], None]] = None,
+) -> int:
+    """Write an image to an open device so that it's never left half-valid.
+
+    The first block at `target_offset` (where the MLO TOC or U-Boot header is)
+    is cleared and the device synced first. Then the rest of the image is
+    written (see `write_image`) and synced, and finally the first block of the
+    image is written and synced. If this is interrupted, the device either has
+    the old image, an image without a valid header (which the ROM bootloader
+    skips over to try the next copy), or the new image.
+
+    If `on_stage` is given, it is called with "header-cleared" and "written" as
+    those steps are synced. `target_offset` must be block-aligned. The number of
+    bytes written is returned.
+    """
+    header_len = min(block_size, source_image.size)
+    header_view = allocate_aligned_buffer(block_size)
+    with profiler.phase("write"):
+        written = 0
+        while written < block_size:
+            written += os.pwrite(
+                fd,
+                header_view[written:],
+                target_offset + written,
+            )
+        profiler.count("writes")
+        profiler.count("bytes_written", block_size)
+    with profiler.phase("fsync"):
+        os.fsync(fd)
+    if on_stage is not None:
+        on_stage("header-cleared")
+    bytes_written = block_size
+    if source_image.size > header_len:
+        body_image = FirmwareImage(
+            source_image.device,
+            source_image.offset + header_len,
+            source_image.kind,
+            source_image.size - header_len,
+        )
+        with profiler.phase("write"):
+            bytes_written += write_image(
+                fd,
+                body_image,
+                target_offset + header_len,
+                block_size,
+                delta,
+            )
+        with profiler.phase("fsync"):
             os.fsync(fd)
+    header_image = FirmwareImage(
+        source_image.device,
+        source_image.offset,
+        source_image.kind,
+        header_len,
+    )
+    with profiler.phase("write"):
+        # The block was just cleared, so there's no point comparing it
+        bytes_written += write_image(
+            fd,
+            header_image,
+            target_offset,
+            block_size,
+            delta=False,
+        )
+    with profiler.phase("fsync"):
+        os.fsync(fd)
+    if on_stage is not None:
+        on_stage("written")
+    return bytes_written
+
+
+DEFAULT_JOURNAL_PATH = "/var/lib/cluster-netboot/am335x-update-journal.json"
+
+
+class JournalError(Exception):
+    """Raised when the update journal can't be saved."""
+    pass
+
+
+class UpdateJournal(object):
+    """A write-ahead journal of firmware image updates.
+
+    Every write is recorded (as "pending") before any of them are made, and
+    each entry is then updated as the write progresses ("header-cleared",
+    "written", and "verified"). The journal is synced to disk at every step, so
+    if an update is interrupted (for example by a power loss), the next run can
+    find the images that were left unfinished, even if their headers were
+    cleared and they can no longer be found on the device (see
+    `find_interrupted_images`). Finished entries are removed, along with the
+    file once there's nothing left in it.
+
+    Devices are identified with `get_device_id`, so entries follow the card
+    even if the device names change between boots.
+    """
+
+    #: The path of the journal file.
+    path: os.PathLike
+
+    #: The journal entries, in the order they were added.
+    entries: typing.List[typing.Dict[str, typing.Any]]
+
+    def __init__(self, path: os.PathLike = DEFAULT_JOURNAL_PATH):
+        import json
+
+        self.path = path
+        self.entries = []
+        self._device_ids: typing.Dict[os.PathLike, str] = {}
+        try:
+            with open(self.path, "r") as journal_file:
+                entries = json.load(journal_file)
+        except FileNotFoundError:
+            log.debug("No update journal at %s", self.path)
+        except (OSError, ValueError) as exc:
+            log.warning(
+                "Ignoring unreadable update journal %s: %s",
+                self.path,
+                exc,
+            )
+        else:
+            if isinstance(entries, list):
+                self.entries = entries
+
+    def _device_id(self, device_path: os.PathLike) -> str:
+        if device_path not in self._device_ids:
+            self._device_ids[device_path] = get_device_id(device_path)
+        return self._device_ids[device_path]
+
+    def _find(
+        self,
+        image: FirmwareImage,
+    ) -> typing.Optional[typing.Dict[str, typing.Any]]:
+        device_id = self._device_id(image.device)
+        for entry in self.entries:
+            if (
+                entry["device_id"] == device_id
+                and entry["offset"] == image.offset
+            ):
+                return entry
+        return None
+
+    def unfinished(
+        self,
+        device_path: os.PathLike,
+    ) -> typing.Sequence[typing.Dict[str, typing.Any]]:
+        """Return the entries for a device that were not verified."""
+        device_id = self._device_id(device_path)
+        return [
+            entry for entry in self.entries
+            if entry["device_id"] == device_id and entry["state"] != "verified"
+        ]
+
+    def begin(self, writes: typing.Iterable[PendingWrite]):
+        """Record a batch of writes that are about to be made."""
+        for source_image, target_image in writes:
+            entry = self._find(target_image)
+            if entry is None:
+                entry = {
+                    "device_id": self._device_id(target_image.device),
+                    "offset": target_image.offset,
+                }
+                self.entries.append(entry)
+            entry.update({
+                "device": os.fsdecode(target_image.device),
+                "kind": target_image.kind.name,
+                "size": source_image.size,
+                "source": os.fsdecode(source_image.path),
+                "sha256": source_image.hexdigest,
+                "state": "pending",
+            })
+        self.save()
+
+    def mark(self, image: FirmwareImage, state: str):
+        """Update the state of the entry for an image, and save the journal."""
+        entry = self._find(image)
+        if entry is None:
+            raise KeyError(f"{image} is not in the update journal")
+        log.debug("Journal: %s is %s", image, state)
+        entry["state"] = state
+        self.save()
+
+    def finish(self):
+        """Remove the verified entries, and the file if it's now empty."""
+        self.entries = [
+            entry for entry in self.entries if entry["state"] != "verified"
+        ]
+        if self.entries:
+            self.save()
+            return
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        except OSError as exc:
+            raise JournalError(
+                f"Unable to remove update journal {self.path}: {exc}"
+            ) from exc
+        else:
+            self._sync_dir()
+
+    def _sync_dir(self):
+        journal_dir = os.path.dirname(self.path) or "."
+        dir_fd = os.open(journal_dir, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+    def save(self):
+        """Write the journal to disk, and wait for it to be synced.
+
+        Unlike `DigestCache.save`, failures raise `JournalError`, as images
+        should not be written without a journal.
+        """
+        import json
+
+        temp_path = f"{self.path}.tmp"
+        try:
+            journal_dir = os.path.dirname(self.path)
+            if journal_dir:
+                os.makedirs(journal_dir, exist_ok=True)
+            with open(temp_path, "w") as journal_file:
+                json.dump(self.entries, journal_file, indent=1)
+                journal_file.flush()
+                os.fsync(journal_file.fileno())
+            os.replace(temp_path, self.path)
+            self._sync_dir()
+        except OSError as exc:
+            raise JournalError(
+                f"Unable to save update journal {self.path}: {exc}"
+            ) from exc
+
+
+def write_journaled(
+    fd: int,
+    source_image: FirmwareImage,
+    target_image: FirmwareImage,
+    block_size: int,
+    delta: bool,
+    journal: UpdateJournal,
+    report: typing.Optional[DeviceReport] = None,
+) -> int:
+    """Write, verify and journal a single image for `write_images`."""
+    device_path = target_image.device
+    if target_image.offset % block_size != 0:
+        raise ValueError(
+            f"{target_image} is not aligned to {block_size}-byte blocks, and "
+            "can't be written safely"
+        )
+    start_time = time.monotonic()
+    with profiler.phase("staged_write", device_path):
+        write_size = write_image_staged(
+            fd,
+            source_image,
+            target_image.offset,
+            block_size,
+            delta,
+            functools.partial(journal.mark, target_image),
+        )
+    if report is not None:
+        report.add_timing("write", start_time)
+        image_report = report.find_image(target_image)
+        if image_report is not None:
+            image_report.action = "updated"
+            image_report.bytes_written = write_size
+    print(
+        f"Wrote {write_size} bytes of {source_image.path} to "
+        f"{device_path} at {target_image.offset:#x} in "
+        f"{time.monotonic() - start_time:.3f}s"
+    )
+    start_time = time.monotonic()
+    with profiler.phase("verify", device_path):
+        matches = verify_image(
+            device_path,
+            source_image,
+            target_image.offset,
+            block_size,
+        )
+    if report is not None:
+        report.add_timing("verify", start_time)
+    if not matches:
+        raise WriteVerificationError(
+            f"{source_image.path} on {device_path} at "
+            f"{target_image.offset:#x} does not match after writing, so no "
+            "more images will be written"
+        )
+    journal.mark(target_image, "verified")
+    print(
+        f"Verified {source_image.path} on {device_path} at "
+        f"{target_image.offset:#x} in {time.monotonic() - start_time:.3f}s"
+    )
+    return write_size
+
+
+def write_images(
+    writes: typing.Iterable[PendingWrite],
+    digest_cache: typing.Optional[DigestCache] = None,
+    delta: bool = True,
+    direct: bool = False,
+    verify: bool = False,
+    reports: typing.Optional[typing.Mapping[os.PathLike, DeviceReport]] = None,
+    journal: typing.Optional[UpdateJournal] = None,
+) -> typing.Dict[os.PathLike, int]:
+    """Write a batch of images, syncing each device only once.
+
+    The writes are grouped by device, and each device is opened once with the
+    writes made in offset order. Each device is synced after all of its writes
+    have been made. If `direct` is `True`, devices are opened with `O_DIRECT`
+    so the writes bypass the page cache. See `write_image` for `delta`. If a
+    target image is not aligned to the device's block size, the entire image is
+    written with `write_image_full` instead (which can't be used with
+    `direct`).
+
+    If `verify` is `True`, each image is read back after the device has been
+    synced (see `verify_image`), and `WriteVerificationError` is raised if any
+    of them do not match.
+
+    A progress message with timing is printed for each write, and the number of
+    bytes written to each device is returned. If `digest_cache` is given, any
+    cached digests for the overwritten regions are removed. If `reports` is
+    given, the images written are marked as updated in the report for their
+    device, and the time taken is added to it.
+
+    Without a `journal` (the default from the command line), this is the fast
+    path: each device is synced once, after all of its writes. If `journal` is
+    given, every write is recorded in it before anything is written. Images
+    are then written one at a time with `write_image_staged`, and each one is
+    verified before moving on to the next, regardless of `verify`. If an image
+    does not match, `WriteVerificationError` is raised straight away, leaving
+    any other copies untouched. Journaled writes must be block-aligned. The
+    verified entries are left in the journal for the caller to
+    `UpdateJournal.finish`.
+    """
+    if reports is None:
+        reports = {}
+    writes = list(writes)
+    writes_by_device: typing.Dict[os.PathLike, typing.List[PendingWrite]] = {}
+    for write in writes:
+        writes_by_device.setdefault(write.target.device, []).append(write)
+    if journal is not None:
+        journal.begin(writes)
+    bytes_written = {}
+    for device_path, device_writes in writes_by_device.items():
+        device_writes.sort(key=lambda w: w.target.offset)
+        block_size = get_block_size(device_path)
+        flags = os.O_RDWR
+        if direct:
+            flags |= os.O_DIRECT
+        bytes_written[device_path] = 0
+        report = reports.get(device_path)
+        fd = os.open(device_path, flags)
+        try:
+            os.set_blocking(fd, True)
+            for source_image, target_image in device_writes:
+                if digest_cache is not None:
+                    digest_cache.invalidate(
+                        device_path,
+                        target_image.offset,
+                        source_image.size,
+                    )
+                start_time = time.monotonic()
+                if journal is not None:
+                    write_size = write_journaled(
+                        fd,
+                        source_image,
+                        target_image,
+                        block_size,
+                        delta,
+                        journal,
+                        report,
+                    )
+                    bytes_written[device_path] += write_size
+                    continue
+                with profiler.phase("write", device_path):
+                    if target_image.offset % block_size == 0:
+                        write_size = write_image(
+                            fd,
+                            source_image,
+                            target_image.offset,
+                            block_size,
+                            delta,
+                        )
+                    elif direct:
+                        raise ValueError(
+                            f"{target_image} is not aligned to {block_size}-byte "
+                            "blocks, and can't be written with direct I/O"
+                        )
+                    else:
+                        log.info(
+                            "%s is not aligned to %d-byte blocks, writing the "
+                            "entire image",
+                            target_image,
+                            block_size,
+                        )
+                        write_size = write_image_full(
+                            fd,
+                            source_image,
+                            target_image.offset,
+                        )
+                bytes_written[device_path] += write_size
+                if report is not None:
+                    report.add_timing("write", start_time)
+                    image_report = report.find_image(target_image)
+                    if image_report is not None:
+                        image_report.action = "updated"
+                        image_report.bytes_written = write_size
+                print(
+                    f"Wrote {write_size} bytes of {source_image.path} to "
+                    f"{device_path} at {target_image.offset:#x} in "
+                    f"{time.monotonic() - start_time:.3f}s"
+                )
+            if journal is not None:
+                # Already synced (and verified) one image at a time
+                continue
+            start_time = time.monotonic()
+            with profiler.phase("fsync", device_path):
+                os.fsync(fd)
+            if report is not None:
+                report.add_timing("fsync", start_time)
+            print(
+                f"Synced {device_path} in {time.monotonic() - start_time:.3f}s"
+            )
         finally:
             os.close(fd)
+        if not verify or journal is not None:
+            continue
+        failed_writes = []
+        for source_image, target_image in device_writes:
+            start_time = time.monotonic()
+            with profiler.phase("verify", device_path):
+                matches = verify_image(
+                    device_path,
+                    source_image,
+                    target_image.offset,
+                    block_size,
+                )
+            if report is not None:
+                report.add_timing("verify", start_time)
+            if matches:
+                print(
+                    f"Verified {source_image.path} on {device_path} at "
+                    f"{target_image.offset:#x} in "
+                    f"{time.monotonic() - start_time:.3f}s"
+                )
+            else:
+                log.error(
+                    "%s on %s at %#x does not match after writing",
+                    source_image.path,
+                    device_path,
+                    target_image.offset,
+                )
+                failed_writes.append(target_image)
+        if failed_writes:
+            raise WriteVerificationError(
+                f"{len(failed_writes)} images on {device_path} did not match "
+                "after writing"
+            )
+    return bytes_written
+
+
+def copy_raw(
+    source_image: FirmwareImage,
+    target_image: FirmwareImage,
+    digest_cache: typing.Optional[DigestCache] = None,
+    delta: bool = True,
+) -> int:
+    """Copy the contents of one image over another image.
+
+    This is `write_images` for a single image. The number of bytes actually
+    written is returned.
+    """
+    bytes_written = write_images(
+        [PendingWrite(source_image, target_image)],
+        digest_cache,
+        delta,
+    )
+    return bytes_written[target_image.device]
 
 
 class MainAction(enum.Enum):
@@ -679,25 +2756,14 @@ class MainAction(enum.Enum):
     FORCE = enum.auto()
 
 
-def update_raw_beaglebone(
+def load_source_images(
     new_mlo_path: os.PathLike,
-    new_u_boot_path: os.PathLike,
-    devices: typing.Iterable[os.PathLike],
-    action: MainAction,
-) -> bool:
-    """Update a raw MMC device with updated firmware images.
-
-    The source images are checked that they are able to be used as boot images,
-    then the given devices are searched for existing images. For any images
-    found, they are compared against the appropriate source image (MLO images to
-    MLO images, U-Boot to U-Boot). If the images on device are different, they
-    are (optionally) overwritten with the source images. The partition table is
-    also examined to ensure that the new images will not overlap with the
-    beginning of the first partition.
+    new_u_boot_path: os.PathLike,
+) -> typing.Tuple[FirmwareImage, FirmwareImage]:
+    """Check the source MLO and U-Boot files, and return them as images.
 
     This function will raise `FileNotFoundError` for missing source files and
     `ValueError` when the given files are not the right kind of image.
-    It returns a boolean for if there were outdated images present.
     """
     if not os.path.exists(new_mlo_path):
         raise FileNotFoundError(
@@ -734,16 +2800,241 @@ def update_raw_beaglebone(
                 break
         else:
             raise ValueError(f"{new_u_boot_path} is not a valid U-Boot image")
-    new_mlo = FirmwareImage(new_mlo_path, ImageKind.MLO)
-    new_u_boot = FirmwareImage(new_u_boot_path, ImageKind.UBOOT)
+    new_mlo = FirmwareImage.from_file(new_mlo_path, ImageKind.MLO)
+    new_u_boot = FirmwareImage.from_file(new_u_boot_path, ImageKind.UBOOT)
+    return new_mlo, new_u_boot
+
+
+def load_and_compare_images(
+    new_mlo_path: os.PathLike,
+    new_u_boot_path: os.PathLike,
+    device_paths: typing.Iterable[os.PathLike],
+    digest_cache: typing.Optional[DigestCache] = None,
+    reports: typing.Optional[typing.Mapping[os.PathLike, DeviceReport]] = None,
+    scan: bool = False,
+    hash_sources: bool = False,
+) -> typing.Tuple[FirmwareImage, FirmwareImage, typing.List[FirmwareImage]]:
+    """Check the source images, and find the outdated images on devices.
+
+    This is `load_source_images` followed by `compare_images`, except that the
+    steps overlap: the devices are scanned (see `scan_device`) in the
+    background while the source files are checked, and each device is compared
+    as soon as its scan is done. The outdated images are still returned in the
+    same order as `device_paths`, along with the source MLO and U-Boot images.
+
+    The digests of the source images are only needed for `digest_cache`, for
+    `reports`, and for journaling the writes. If any of those are used (pass
+    `hash_sources` for the journal), the source images are also hashed in the
+    background.
+
+    This function raises the same exceptions as `load_source_images`. Any
+    device scans that were started are finished first.
+    """
+    import concurrent.futures
+
+    device_paths = list(device_paths)
+    if reports is None:
+        reports = {}
+    hash_sources = hash_sources or digest_cache is not None or bool(reports)
+    # Scans, hashes and compares are all mostly waiting on I/O or in hashlib,
+    # so threads are enough. Two extra threads for hashing the source images.
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=len(device_paths) + 2
+    ) as executor:
+        scan_futures = [
+            executor.submit(
+                scan_device,
+                device_path,
+                reports.get(device_path),
+                scan,
+            )
+            for device_path in device_paths
+        ]
+        new_mlo, new_u_boot = load_source_images(
+            new_mlo_path,
+            new_u_boot_path,
+        )
+        hash_futures = {}
+        if hash_sources:
+            hash_futures = {
+                image: executor.submit(image.compute_digest)
+                for image in (new_mlo, new_u_boot)
+            }
+        compare_futures = []
+        # Waiting on the scans in order keeps the results in order, and the
+        # compares for the first devices can start while the others are still
+        # being scanned.
+        for scan_future in scan_futures:
+            device_scan = scan_future.result()
+            compare_futures.append(executor.submit(
+                compare_scanned_images,
+                new_mlo,
+                new_u_boot,
+                device_scan,
+                digest_cache,
+                reports.get(device_scan.device),
+            ))
+        outdated_images = list(itertools.chain.from_iterable(
+            future.result() for future in compare_futures
+        ))
+        for image, future in hash_futures.items():
+            log.debug("%s has digest %s", image, future.result())
+    return new_mlo, new_u_boot, outdated_images
+
+
+def find_interrupted_images(
+    journal: UpdateJournal,
+    new_images: typing.Mapping[ImageKind, FirmwareImage],
+    device_paths: typing.Iterable[os.PathLike],
+) -> typing.Tuple[typing.List[FirmwareImage], typing.List[FirmwareImage]]:
+    """Find the images on devices left unfinished by an interrupted update.
+
+    Each unfinished entry in `journal` for the given devices is checked against
+    the current source image of the same kind (which may be newer than the one
+    being written when the update was interrupted). Two lists are returned: the
+    images that still need to be written, and the images that turned out to
+    have already been completely written. Images that would now overlap the
+    first partition are logged and left out of both lists.
+    """
+    interrupted_images = []
+    finished_images = []
+    for device_path in device_paths:
+        entries = journal.unfinished(device_path)
+        if not entries:
+            continue
+        block_size = get_block_size(device_path)
+        region = read_boot_region(
+            device_path,
+            align_up(BOOT_REGION_SIZE, block_size),
+        )
+        with BufferReader(region, device_path) as device:
+            partition_start = find_first_partition(device, block_size)
+        for entry in entries:
+            kind = ImageKind[entry["kind"]]
+            new_image = new_images[kind]
+            image = FirmwareImage(
+                device_path,
+                entry["offset"],
+                kind,
+                entry["size"],
+            )
+            log.warning(
+                "The update of %s was interrupted (it was %s)",
+                image,
+                entry["state"],
+            )
+            if entry["sha256"] != new_image.hexdigest:
+                log.info(
+                    "%s was being written from %s, which has since changed",
+                    image,
+                    entry["source"],
+                )
+            if verify_image(device_path, new_image, image.offset, block_size):
+                log.info("%s was already completely written", image)
+                finished_images.append(image)
+                continue
+            target = new_image.rebase(image.offset, device_path)
+            if partition_start is None or target.end > partition_start:
+                log.error(
+                    "Unable to finish the update of %s, as %s would overlap "
+                    "the first partition",
+                    image,
+                    new_image.path,
+                )
+                continue
+            interrupted_images.append(target)
+    return interrupted_images, finished_images
+
+
+def update_raw_beaglebone(
+    new_mlo_path: os.PathLike,
+    new_u_boot_path: os.PathLike,
+    devices: typing.Iterable[os.PathLike],
+    action: MainAction,
+    digest_cache: typing.Optional[DigestCache] = None,
+    delta_write: bool = True,
+    direct_io: bool = False,
+    verify_writes: bool = False,
+    reports: typing.Optional[typing.Mapping[os.PathLike, DeviceReport]] = None,
+    scan: bool = False,
+    journal: typing.Optional[UpdateJournal] = None,
+) -> bool:
+    """Update a raw MMC device with updated firmware images.
+
+    The source images are checked that they are able to be used as boot images,
+    while the given devices are searched for existing images (see
+    `load_and_compare_images`). For any images found, they are compared against
+    the appropriate source image (MLO images to MLO images, U-Boot to U-Boot).
+    If the images on device are different, they are (optionally) overwritten
+    with the source images. The partition table is also examined to ensure that
+    the new images will not overlap with the beginning of the first partition.
+    All of the writes are made at the end, in one batch (see `write_images`),
+    and are optionally read back to verify them.
+
+    This function will raise `FileNotFoundError` for missing source files and
+    `ValueError` when the given files are not the right kind of image.
+    `WriteVerificationError` is raised if `verify_writes` is `True` and an
+    image did not match after being written.
+    It returns a boolean for if there were outdated images present. If
+    `reports` is given, the reports for each device are filled in with what was
+    found and done. If `scan` is `True`, the devices are scanned for images at
+    any offset before the first partition (see `compare_images`).
+
+    If `journal` is given, the writes are journaled (see `write_images`), and
+    any images left unfinished by an earlier, interrupted update are treated as
+    outdated (see `find_interrupted_images`), as they may not be found on the
+    device any more. `JournalError` is raised if the journal can't be saved.
+    """
+    if reports is None:
+        reports = {}
+    devices = list(devices)
+    new_mlo, new_u_boot, outdated_images = load_and_compare_images(
+        new_mlo_path,
+        new_u_boot_path,
+        devices,
+        digest_cache,
+        reports,
+        scan,
+        journal is not None,
+    )
     new_images = {
         ImageKind.MLO: new_mlo,
         ImageKind.UBOOT: new_u_boot,
     }
-    outdated_images = list(compare_images(new_mlo, new_u_boot, devices))
+    if journal is not None:
+        interrupted_images, finished_images = find_interrupted_images(
+            journal,
+            new_images,
+            devices,
+        )
+        outdated_ranges = {
+            (image.device, image.offset) for image in outdated_images
+        }
+        for image in interrupted_images:
+            if (image.device, image.offset) in outdated_ranges:
+                continue
+            outdated_images.append(image)
+            if image.device in reports:
+                image_report = reports[image.device].find_image(image)
+                if image_report is None:
+                    image_report = ImageReport(image)
+                    reports[image.device].images.append(image_report)
+                image_report.outdated = True
+                image_report.action = "none"
+        if finished_images and action is not MainAction.DRY_RUN:
+            for image in finished_images:
+                journal.mark(image, "verified")
+            journal.finish()
     # Sort the images by kind, then device, then by offset
     outdated_images.sort(key=lambda i: (i.kind, i.device, i.offset))
+    pending_writes = []
     for image in outdated_images:
+        image_report = None
+        if image.device in reports:
+            image_report = reports[image.device].find_image(image)
+        if image_report is None:
+            # Not keeping a report for this device, so use a throwaway one
+            image_report = ImageReport(image)
         destination_message = (
             f"{image.kind.value} at {image.offset:#x} "
             f"({image.size} bytes) on {image.device}"
@@ -753,6 +3044,7 @@ def update_raw_beaglebone(
             f"({new_images[image.kind].size} bytes)"
         )
         if action is MainAction.DRY_RUN:
+            image_report.action = "would-update"
             print(
                 f"{destination_message} would be overwritten by "
                 f"{source_message}"
@@ -762,7 +3054,7 @@ def update_raw_beaglebone(
                 f"{destination_message} will be overwritten with the contents "
                 f"of {source_message}"
             )
-            copy_raw(new_images[image.kind], image)
+            pending_writes.append(PendingWrite(new_images[image.kind], image))
         elif action is MainAction.INTERACTIVE:
             response = input(
                 f"Should {destination_message} be overwritten by "
@@ -770,19 +3062,605 @@ def update_raw_beaglebone(
             )
             cleaned_response = response.lower().strip()
             if cleaned_response not in ("y", "yes"):
+                image_report.action = "skipped"
                 print("Skipping...")
             else:
-                copy_raw(new_images[image.kind], image)
+                pending_writes.append(
+                    PendingWrite(new_images[image.kind], image)
+                )
+    if pending_writes:
+        write_images(
+            pending_writes,
+            digest_cache,
+            delta_write,
+            direct_io,
+            verify_writes,
+            reports,
+            journal,
+        )
+        if journal is not None:
+            journal.finish()
+    if digest_cache is not None:
+        digest_cache.save()
     return bool(outdated_images)
 
 
+def expand_fleet_paths(
+    patterns: typing.Iterable[str],
+    manifest_path: typing.Optional[os.PathLike] = None,
+) -> typing.Sequence[str]:
+    """Expand the disk images and devices to check in fleet mode.
+
+    Each pattern is a path or glob pattern. If `manifest_path` is given, it is
+    a file with one path or glob pattern per line (blank lines and lines
+    starting with "#" are skipped). Duplicate paths are only included once,
+    and patterns that do not match anything are logged and skipped.
+    """
+    import glob
+
+    patterns = list(patterns)
+    if manifest_path is not None:
+        with open(manifest_path, "r") as manifest:
+            for line in manifest:
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    patterns.append(line)
+    paths: typing.Dict[str, None] = {}
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        if not matches:
+            log.warning("No disk images matching '%s' found.", pattern)
+        for match in matches:
+            paths.setdefault(match, None)
+    return list(paths)
+
+
+class FleetResult(typing.NamedTuple):
+    """The result of checking (and possibly updating) one fleet image."""
+
+    #: The disk image or device that was checked.
+    path: str
+
+    #: The outdated firmware images found.
+    outdated_images: typing.Sequence[FirmwareImage]
+
+    #: How many of the outdated images were overwritten.
+    updated_count: int
+
+    #: How many bytes were written when updating images.
+    bytes_written: int
+
+    #: If the image could not be checked, the reason why.
+    error: typing.Optional[str]
+
+
+def update_fleet_image(
+    new_images: typing.Mapping[ImageKind, FirmwareImage],
+    path: str,
+    action: MainAction,
+    digest_cache: typing.Optional[DigestCache] = None,
+    delta_write: bool = True,
+    direct_io: bool = False,
+    verify_writes: bool = False,
+    scan: bool = False,
+    report: typing.Optional[DeviceReport] = None,
+) -> FleetResult:
+    """Check and (optionally) update a single disk image for `update_fleet`.
+
+    If `report` is given, it is filled in for the disk image, including the
+    error if the image couldn't be checked.
+    """
+    reports = {path: report} if report is not None else None
+    try:
+        outdated_images = compare_device_images(
+            new_images[ImageKind.MLO],
+            new_images[ImageKind.UBOOT],
+            path,
+            digest_cache,
+            report,
+            scan=scan,
+        )
+        updated_count = 0
+        bytes_written = 0
+        if action is MainAction.FORCE and outdated_images:
+            device_bytes_written = write_images(
+                [
+                    PendingWrite(new_images[image.kind], image)
+                    for image in outdated_images
+                ],
+                digest_cache,
+                delta_write,
+                direct_io,
+                verify_writes,
+                reports,
+            )
+            bytes_written = sum(device_bytes_written.values())
+            updated_count = len(outdated_images)
+        elif report is not None:
+            for image in outdated_images:
+                image_report = report.find_image(image)
+                if image_report is not None:
+                    image_report.action = "would-update"
+    except (
+        InvalidFirmwareImage,
+        WriteVerificationError,
+        OSError,
+        # Raised by write_images() for writes it can't do, like misaligned
+        # images with direct I/O.
+        ValueError,
+    ) as exc:
+        log.error("Unable to check %s: %s", path, exc)
+        if report is not None:
+            report.error = str(exc)
+        return FleetResult(path, [], 0, 0, str(exc))
+    return FleetResult(
+        path,
+        outdated_images,
+        updated_count,
+        bytes_written,
+        None,
+    )
+
+
+def update_fleet(
+    new_mlo_path: os.PathLike,
+    new_u_boot_path: os.PathLike,
+    paths: typing.Sequence[str],
+    action: MainAction,
+    jobs: int,
+    digest_cache: typing.Optional[DigestCache] = None,
+    delta_write: bool = True,
+    direct_io: bool = False,
+    verify_writes: bool = False,
+    scan: bool = False,
+    reports: typing.Optional[typing.Mapping[os.PathLike, DeviceReport]] = None,
+) -> bool:
+    """Check (and optionally update) the bootloaders in many disk images.
+
+    This is meant to be run on a server holding raw disk images (or loop
+    devices) for many nodes, instead of on the nodes themselves. Up to `jobs`
+    images are handled at once. Interactive confirmation is not supported, so
+    `action` must be either `MainAction.DRY_RUN` or `MainAction.FORCE`. A report
+    of every image is printed once all of them have been checked. If `reports`
+    is given, the report for each disk image in it is filled in as well.
+
+    This function will raise `FileNotFoundError` and `ValueError` in the same
+    cases as `update_raw_beaglebone`. It returns a boolean for if any images
+    were outdated, or could not be checked.
+    """
+    import concurrent.futures
+
+    if action is MainAction.INTERACTIVE:
+        raise ValueError("Interactive updates are not supported in fleet mode")
+    new_mlo, new_u_boot = load_source_images(new_mlo_path, new_u_boot_path)
+    new_images = {
+        ImageKind.MLO: new_mlo,
+        ImageKind.UBOOT: new_u_boot,
+    }
+    if reports is None:
+        reports = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        results = list(executor.map(
+            lambda path: update_fleet_image(
+                new_images,
+                path,
+                action=action,
+                digest_cache=digest_cache,
+                delta_write=delta_write,
+                direct_io=direct_io,
+                verify_writes=verify_writes,
+                scan=scan,
+                report=reports.get(path),
+            ),
+            paths,
+        ))
+    if digest_cache is not None:
+        digest_cache.save()
+    path_width = max((len(result.path) for result in results), default=0)
+    outdated_count = 0
+    error_count = 0
+    for result in results:
+        if result.error is not None:
+            error_count += 1
+            status = f"error: {result.error}"
+        elif not result.outdated_images:
+            status = "up to date"
+        else:
+            outdated_count += 1
+            status = ", ".join(
+                f"{image.kind.value} at {image.offset:#x}"
+                for image in result.outdated_images
+            )
+            if action is MainAction.FORCE:
+                status = (
+                    f"updated {status} ({result.bytes_written} bytes written)"
+                )
+            else:
+                status = f"outdated {status}"
+        print(f"{result.path:<{path_width}}  {status}")
+    print(
+        f"{len(results)} images checked, {outdated_count} outdated, "
+        f"{error_count} errors"
+    )
+    return bool(outdated_count or error_count)
+
+
+#: The MMC devices checked when no devices are given.
+DEFAULT_DEVICE_PATHS = ("/dev/mmcblk0", "/dev/mmcblk1")
+
+DEFAULT_DAEMON_SOCKET_PATH = "/run/am335x-updater.sock"
+
+#: The netlink protocol for kernel uevents (from linux/netlink.h).
+NETLINK_KOBJECT_UEVENT = 15
+
+
+def build_report(
+    mlo_path: os.PathLike,
+    u_boot_path: os.PathLike,
+    reports: typing.Iterable[DeviceReport],
+    outdated: bool,
+    error: typing.Optional[str],
+    exit_status: int,
+) -> typing.Dict[str, typing.Any]:
+    """Build the machine-readable report for `--format json` (and the daemon).
+    """
+    return {
+        "mlo": os.fsdecode(mlo_path),
+        "uboot": os.fsdecode(u_boot_path),
+        "devices": [report.to_json() for report in reports],
+        "outdated": outdated,
+        "error": error,
+        # The exit status as seen by the shell
+        "exit_status": exit_status & 0xff,
+        "profile": profiler.to_json() if profiler.enabled else None,
+    }
+
+
+def is_on_disk(device_name: str, disk_name: str) -> bool:
+    """Check if a kernel block device name is a disk, or a partition on it.
+
+    This uses the kernel's partition naming scheme ("sda" has partitions like
+    "sda1", and "mmcblk0" has "mmcblk0p1"), instead of sysfs, as a partition
+    may already be gone when its "remove" uevent arrives.
+    """
+    if device_name == disk_name:
+        return True
+    separator = "p" if disk_name[-1:].isdigit() else ""
+    return re.fullmatch(
+        re.escape(disk_name) + separator + r"\d+",
+        device_name,
+    ) is not None
+
+
+class UpdaterDaemon(object):
+    """Keeps the results of checking devices, for answering daemon requests.
+
+    The source images are only loaded again when the files change, and each
+    device is only checked again after `invalidate` is called for it (which
+    `run_daemon` does when the kernel reports a change to the device). Requests
+    are handled one at a time.
+    """
+
+    #: Paths to the source MLO and U-Boot files.
+    mlo_path: os.PathLike
+    u_boot_path: os.PathLike
+
+    #: The devices to check (if they are present when a request is made).
+    device_paths: typing.Sequence[os.PathLike]
+
+    #: If `False`, device changes aren't being watched for, so every device is
+    #: checked for every request.
+    watching: bool
+
+    def __init__(
+        self,
+        mlo_path: os.PathLike,
+        u_boot_path: os.PathLike,
+        device_paths: typing.Iterable[os.PathLike] = DEFAULT_DEVICE_PATHS,
+        digest_cache: typing.Optional[DigestCache] = None,
+        journal: typing.Optional[UpdateJournal] = None,
+        delta_write: bool = True,
+        direct_io: bool = False,
+        verify_writes: bool = False,
+        scan: bool = False,
+    ):
+        self.mlo_path = mlo_path
+        self.u_boot_path = u_boot_path
+        self.device_paths = list(device_paths)
+        self.watching = False
+        self._digest_cache = digest_cache
+        self._journal = journal
+        self._delta_write = delta_write
+        self._direct_io = direct_io
+        self._verify_writes = verify_writes
+        self._scan = scan
+        self._lock = threading.Lock()
+        self._source_key = None
+        self._source_images: typing.Dict[ImageKind, FirmwareImage] = {}
+        self._results: typing.Dict[
+            os.PathLike,
+            typing.Tuple[DeviceReport, typing.Sequence[FirmwareImage]],
+        ] = {}
+
+    def present_devices(self) -> typing.Sequence[os.PathLike]:
+        """The devices that currently exist."""
+        return [path for path in self.device_paths if os.path.exists(path)]
+
+    def _load_sources(self) -> typing.Dict[ImageKind, FirmwareImage]:
+        # Source files are replaced (not modified in place) by package
+        # upgrades, so the inode, size and mtime are enough to spot changes.
+        source_key = tuple(
+            (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+            for stat in map(os.stat, (self.mlo_path, self.u_boot_path))
+        )
+        if source_key != self._source_key:
+            log.info("Loading source images")
+            new_mlo, new_u_boot = load_source_images(
+                self.mlo_path,
+                self.u_boot_path,
+            )
+            self._source_images = {
+                ImageKind.MLO: new_mlo,
+                ImageKind.UBOOT: new_u_boot,
+            }
+            self._source_key = source_key
+            self._results.clear()
+        return self._source_images
+
+    def invalidate(self, device_name: typing.Optional[str] = None):
+        """Forget the results for a device, or all devices.
+
+        `device_name` is a kernel device name (like "mmcblk0"). Partitions
+        (like "mmcblk0p1") invalidate the device they are on.
+        """
+        with self._lock:
+            for device_path in list(self._results.keys()):
+                real_name = os.path.basename(os.path.realpath(device_path))
+                if device_name is None or is_on_disk(device_name, real_name):
+                    log.info("Forgetting results for %s", device_path)
+                    del self._results[device_path]
+
+    def check(self) -> typing.Dict[str, typing.Any]:
+        """Check every present device, using the kept results if possible.
+
+        The report is in the same format as `--format json`.
+        """
+        with self._lock:
+            reports = []
+            outdated = False
+            error = None
+            try:
+                new_images = self._load_sources()
+                device_paths = self.present_devices()
+                for device_path in device_paths:
+                    if not self.watching or device_path not in self._results:
+                        report = DeviceReport(device_path)
+                        outdated_images = compare_device_images(
+                            new_images[ImageKind.MLO],
+                            new_images[ImageKind.UBOOT],
+                            device_path,
+                            self._digest_cache,
+                            report,
+                            self._scan,
+                        )
+                        self._results[device_path] = (report, outdated_images)
+                    report, outdated_images = self._results[device_path]
+                    reports.append(report)
+                    outdated = outdated or bool(outdated_images)
+                if self._journal is not None:
+                    interrupted_images, _ = find_interrupted_images(
+                        self._journal,
+                        new_images,
+                        device_paths,
+                    )
+                    outdated = outdated or bool(interrupted_images)
+                if self._digest_cache is not None:
+                    self._digest_cache.save()
+            except (ValueError, OSError) as exc:
+                log.error("%s", exc)
+                error = str(exc)
+            return build_report(
+                self.mlo_path,
+                self.u_boot_path,
+                reports,
+                outdated,
+                error,
+                -1 if error is not None else int(outdated),
+            )
+
+    def update(self) -> typing.Dict[str, typing.Any]:
+        """Update every present device (see `update_raw_beaglebone`).
+
+        Every device is checked again for an update, and the kept results are
+        then forgotten. The report is in the same format as `--format json`.
+        """
+        with self._lock:
+            device_paths = self.present_devices()
+            reports = {
+                device_path: DeviceReport(device_path)
+                for device_path in device_paths
+            }
+            outdated = False
+            error = None
+            try:
+                self._load_sources()
+                outdated = update_raw_beaglebone(
+                    self.mlo_path,
+                    self.u_boot_path,
+                    device_paths,
+                    MainAction.FORCE,
+                    self._digest_cache,
+                    self._delta_write,
+                    self._direct_io,
+                    self._verify_writes,
+                    reports,
+                    self._scan,
+                    self._journal,
+                )
+            except (
+                ValueError,
+                OSError,
+                WriteVerificationError,
+                JournalError,
+            ) as exc:
+                log.error("%s", exc)
+                error = str(exc)
+            finally:
+                self._results.clear()
+            return build_report(
+                self.mlo_path,
+                self.u_boot_path,
+                reports.values(),
+                outdated,
+                error,
+                -1 if error is not None else int(outdated),
+            )
+
+
+def watch_uevents(
+    uevent_socket: socket.socket,
+    daemon: UpdaterDaemon,
+) -> None:
+    """Forget a device's results when the kernel reports a change to it.
+
+    These are the same uevents udev acts on (block devices being added,
+    removed, or changed), read straight from the kernel's netlink socket. This
+    runs forever, so it should be run in its own thread.
+    """
+    while True:
+        message = uevent_socket.recv(16384)
+        # Messages are "ACTION@DEVPATH", then KEY=VALUE pairs, all separated
+        # by null bytes.
+        properties = dict(
+            field.split(b"=", 1)
+            for field in message.split(b"\0")[1:]
+            if b"=" in field
+        )
+        if properties.get(b"SUBSYSTEM") != b"block":
+            continue
+        device_name = os.fsdecode(properties.get(b"DEVNAME", b""))
+        log.debug(
+            "Block device uevent: %s %s",
+            os.fsdecode(properties.get(b"ACTION", b"")),
+            device_name,
+        )
+        if device_name:
+            daemon.invalidate(os.path.basename(device_name))
+
+
+def run_daemon(
+    daemon: UpdaterDaemon,
+    socket_path: os.PathLike = DEFAULT_DAEMON_SOCKET_PATH,
+) -> None:
+    """Answer requests on a Unix socket until interrupted.
+
+    Each request is a line of JSON with an "action" of "check", "update", or
+    "rescan" (which forgets every kept result), and the response is a single
+    line of JSON (see `UpdaterDaemon.check`). The socket is only accessible by
+    root. If uevents can't be watched, every request checks every device.
+    """
+    import json
+    import socket
+    import socketserver
+
+    try:
+        uevent_socket = socket.socket(
+            socket.AF_NETLINK,
+            socket.SOCK_DGRAM,
+            NETLINK_KOBJECT_UEVENT,
+        )
+        # Group 1 is the kernel's own uevents
+        uevent_socket.bind((0, 1))
+    except (AttributeError, OSError) as exc:
+        log.warning(
+            "Unable to watch for device changes, devices will be checked for "
+            "every request: %s",
+            exc,
+        )
+    else:
+        daemon.watching = True
+        threading.Thread(
+            target=watch_uevents,
+            args=(uevent_socket, daemon),
+            name="uevents",
+            daemon=True,
+        ).start()
+
+    class RequestHandler(socketserver.StreamRequestHandler):
+        # Don't let a stuck client block every other request
+        timeout = 10
+
+        def handle(self):
+            try:
+                request = json.loads(self.rfile.readline())
+                action = request["action"]
+            except (OSError, ValueError, TypeError, KeyError) as exc:
+                log.warning("Invalid request: %s", exc)
+                response = {"error": "Invalid request", "exit_status": 255}
+            else:
+                log.info("Handling %s request", action)
+                if action == "check":
+                    response = daemon.check()
+                elif action == "update":
+                    response = daemon.update()
+                elif action == "rescan":
+                    daemon.invalidate()
+                    response = {"error": None, "exit_status": 0}
+                else:
+                    response = {
+                        "error": f"Unknown action '{action}'",
+                        "exit_status": 255,
+                    }
+            self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+
+    # Remove a socket left behind by a previous daemon
+    with contextlib.suppress(FileNotFoundError):
+        os.unlink(socket_path)
+    old_umask = os.umask(0o177)
+    try:
+        server = socketserver.UnixStreamServer(socket_path, RequestHandler)
+    finally:
+        os.umask(old_umask)
+    with server:
+        # Check everything up front, so the first request is fast as well
+        daemon.check()
+        log.info("Listening on %s", socket_path)
+        try:
+            server.serve_forever()
+        finally:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(socket_path)
+
+
+def send_daemon_request(
+    action: str,
+    socket_path: os.PathLike = DEFAULT_DAEMON_SOCKET_PATH,
+) -> typing.Dict[str, typing.Any]:
+    """Send a request to a running daemon, and return its response."""
+    import json
+    import socket
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(os.fsdecode(socket_path))
+        request = json.dumps({"action": action}).encode("utf-8") + b"\n"
+        client.sendall(request)
+        with client.makefile("rb") as response:
+            return json.loads(response.readline())
+
+
 def parse_args() -> argparse.Namespace:
     """Parse command line arguments."""
+    import argparse
+
     # This is pulled into a separate function to keep main() at a mangeable
     # length.
     parser = argparse.ArgumentParser(
         description="Check and update AM335x MMC bootloaders",
-        # TODO: add extra help describing the exit status
+        epilog=(
+            "Exit status: 0 if every installed bootloader matches the given "
+            "files, 1 if any of them did not match (even if they were then "
+            "updated), and 255 on errors."
+        ),
     )
     # Action arguments
     action_group = parser.add_mutually_exclusive_group()
@@ -844,12 +3722,215 @@ def parse_args() -> argparse.Namespace:
             "Specify which MMC devices to check. Can be specified multiple "
             "times. (default: /dev/mmcblk0 and /dev/mmcblk1, if present)."
         ),
-        default=list(filter(
-            os.path.exists,
-            ("/dev/mmcblk0", "/dev/mmcblk1")
-        )),
         dest="devices",
     )
+    cache_group = parser.add_mutually_exclusive_group()
+    cache_group.add_argument(
+        "--digest-cache",
+        action="store_const",
+        const=DEFAULT_DIGEST_CACHE_PATH,
+        help=(
+            "Cache the digests of installed bootloaders at "
+            f"{DEFAULT_DIGEST_CACHE_PATH}. A cached digest is used as long as "
+            "a sample of the image's sectors is unchanged, so an image "
+            "changed only outside of that sample is missed."
+        ),
+        default=None,
+        dest="digest_cache",
+    )
+    cache_group.add_argument(
+        "--digest-cache-path",
+        action="store",
+        help=(
+            "Cache installed bootloader digests (like --digest-cache) at the "
+            "given path."
+        ),
+        dest="digest_cache",
+        metavar="/path/to/cache.json",
+    )
+    cache_group.add_argument(
+        "--no-digest-cache",
+        action="store_const",
+        const=None,
+        help="Do not read or update the digest cache (the default).",
+        dest="digest_cache",
+    )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help=(
+            "Ignore any cached digests and compare every installed bootloader "
+            "directly. The digest cache is still updated."
+        ),
+    )
+    journal_group = parser.add_mutually_exclusive_group()
+    journal_group.add_argument(
+        "--journal",
+        action="store_const",
+        const=DEFAULT_JOURNAL_PATH,
+        help=(
+            f"Keep an update journal at {DEFAULT_JOURNAL_PATH}. Images are "
+            "written, synced, and verified one at a time, with the progress "
+            "recorded in the journal so that an interrupted update is "
+            "finished on the next run. This is slower than the default of "
+            "writing all of a device's images in one batch with a single "
+            "sync, which can leave a device unbootable if interrupted."
+        ),
+        default=None,
+        dest="journal",
+    )
+    journal_group.add_argument(
+        "--journal-path",
+        action="store",
+        help="Keep an update journal (like --journal) at the given path.",
+        dest="journal",
+        metavar="/path/to/journal.json",
+    )
+    journal_group.add_argument(
+        "--no-journal",
+        action="store_const",
+        const=None,
+        help="Don't keep an update journal (the default).",
+        dest="journal",
+    )
+    parser.add_argument(
+        "--full-write",
+        action="store_false",
+        help=(
+            "Write the entire bootloader image when updating, instead of only "
+            "the blocks that have changed."
+        ),
+        dest="delta_write",
+    )
+    parser.add_argument(
+        "--direct-io",
+        action="store_true",
+        help=(
+            "Bypass the page cache (with O_DIRECT) when writing bootloader "
+            "images."
+        ),
+    )
+    parser.add_argument(
+        "--verify-writes",
+        action="store_true",
+        help=(
+            "Read back every bootloader image after it has been written "
+            "(bypassing the page cache), and check it against the source file."
+        ),
+    )
+    parser.add_argument(
+        "--scan",
+        action="store_true",
+        help=(
+            "Look for bootloaders in every sector before the first partition, "
+            "instead of only at the offsets the AM335x ROM boots from."
+        ),
+    )
+    parser.add_argument(
+        "--dtc-cross-check",
+        action="store_true",
+        help=(
+            "Also parse FIT images with dtc, and treat any differences from "
+            "the built-in parser as an invalid image. Only useful for "
+            "debugging."
+        ),
+    )
+    # Fleet mode arguments
+    subparsers = parser.add_subparsers(dest="command", metavar="COMMAND")
+    fleet_parser = subparsers.add_parser(
+        "fleet",
+        help=(
+            "Check the bootloaders in many raw disk images (or loop devices) "
+            "at once, instead of the MMC devices of this machine."
+        ),
+        description=(
+            "Check (and with --force, update) the bootloaders in many raw disk "
+            "images or loop devices, then print a report for all of them. "
+            "Interactive updates are not supported, so this defaults to "
+            "--dry-run unless --force is given."
+        ),
+    )
+    fleet_parser.add_argument(
+        "images",
+        nargs="*",
+        help="Disk images or devices to check. Glob patterns are expanded.",
+        metavar="IMAGE",
+    )
+    fleet_parser.add_argument(
+        "--manifest",
+        action="store",
+        help=(
+            "A file listing disk images or devices to check, one path or glob "
+            "pattern per line."
+        ),
+        metavar="/path/to/manifest",
+    )
+    fleet_parser.add_argument(
+        "--jobs", "-j",
+        action="store",
+        type=int,
+        help="How many images to check at once (default: %(default)s).",
+        default=min(8, os.cpu_count() or 1) * 2,
+    )
+    # Daemon mode arguments
+    daemon_parser = subparsers.add_parser(
+        "daemon",
+        help=(
+            "Keep running, and answer check and update requests on a socket."
+        ),
+        description=(
+            "Keep running, and answer check and update requests (see the "
+            "'request' command) on a Unix socket. The source files are only "
+            "loaded again when they change, and devices are only checked "
+            "again when the kernel reports a change to them, so most requests "
+            "are answered without reading anything. Devices that aren't "
+            "present yet are checked once they appear."
+        ),
+    )
+    request_parser = subparsers.add_parser(
+        "request",
+        help="Send a request to a running daemon.",
+        description=(
+            "Send a request to a running daemon and print the response. The "
+            "exit status is the same as it would be for a normal run. 'rescan' "
+            "makes the daemon check every device again on the next request."
+        ),
+    )
+    request_parser.add_argument(
+        "request_action",
+        choices=("check", "update", "rescan"),
+        help="What to ask the daemon to do.",
+        metavar="{check,update,rescan}",
+    )
+    for subparser in (daemon_parser, request_parser):
+        subparser.add_argument(
+            "--socket",
+            action="store",
+            help="Path to the daemon's socket (default: %(default)s).",
+            default=DEFAULT_DAEMON_SOCKET_PATH,
+            metavar="/path/to/socket",
+        )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help=(
+            "Record the time taken, and the amount of I/O done, by each step "
+            "for each device. A summary table is printed to stderr at the end "
+            "(and included in the report with --format json)."
+        ),
+    )
+    parser.add_argument(
+        "--format",
+        action="store",
+        choices=("text", "json"),
+        help=(
+            "Output format. With 'json', a report of every device (or fleet "
+            "disk image) is written to stdout once done, and all other "
+            "messages go to stderr (default: %(default)s)."
+        ),
+        default="text",
+        dest="output_format",
+    )
     # Logging arguments
     logging_group = parser.add_mutually_exclusive_group()
     logging_group.add_argument(
@@ -872,7 +3953,20 @@ def parse_args() -> argparse.Namespace:
     return parser.parse_args()
 
 
+def print_json(data: typing.Any) -> None:
+    """Print a JSON document to stdout (for `--format json`)."""
+    import json
+
+    json.dump(data, sys.stdout, indent=2)
+    print()
+
+
 def main() -> None:
+    logging.basicConfig(
+        level=logging.WARNING,
+        format="%(levelname)s: %(message)s",
+        stream=sys.stderr,
+    )
     args = parse_args()
     # Update the log level first
     log_levels = {
@@ -887,6 +3981,90 @@ def main() -> None:
         # If all else fails, give a default
         logging.WARNING
     ))
+    global DTC_CROSS_CHECK
+    DTC_CROSS_CHECK = args.dtc_cross_check
+    profiler.enabled = args.profile
+    if args.command == "request":
+        # The daemon does all of the work, and checks the permissions
+        try:
+            response = send_daemon_request(args.request_action, args.socket)
+        except (OSError, ValueError) as exc:
+            log.error("Unable to get a response from the daemon: %s", exc)
+            sys.exit(-1)
+        if args.output_format == "json":
+            print_json(response)
+        else:
+            for device in response.get("devices", []):
+                outdated_images = [
+                    f"{image['kind']} at {image['offset']:#x} "
+                    # Images that weren't touched are just outdated
+                    + ("outdated" if image["action"] == "none"
+                        else image["action"])
+                    for image in device["images"]
+                    if image["outdated"]
+                ]
+                status = ", ".join(outdated_images) or "up to date"
+                print(f"{device['device']}  {status}")
+        if response.get("error") is not None:
+            log.error("%s", response["error"])
+        sys.exit(response.get("exit_status", 255))
+    digest_cache = None
+    if args.digest_cache is not None:
+        digest_cache = DigestCache(args.digest_cache, args.verify)
+    if args.command == "fleet":
+        # Fleet mode runs on a server (so no AM335x check), and can be used on
+        # disk image files by a normal user.
+        if args.action is MainAction.INTERACTIVE:
+            log.info("Interactive updates are not supported in fleet mode")
+            args.action = MainAction.DRY_RUN
+        reports = None
+        output = contextlib.nullcontext()
+        error = None
+        bootloader_difference = False
+        try:
+            paths = expand_fleet_paths(args.images, args.manifest)
+            if args.output_format == "json":
+                reports = {path: DeviceReport(path) for path in paths}
+                # Keep stdout for the report
+                output = contextlib.redirect_stdout(sys.stderr)
+            with output:
+                bootloader_difference = update_fleet(
+                    args.mlo,
+                    args.uboot,
+                    paths,
+                    args.action,
+                    max(1, args.jobs),
+                    digest_cache,
+                    args.delta_write,
+                    args.direct_io,
+                    args.verify_writes,
+                    args.scan,
+                    reports,
+                )
+        except (ValueError, FileNotFoundError) as exc:
+            log.error("%s", exc)
+            error = str(exc)
+        except KeyboardInterrupt:
+            error = "Interrupted"
+        finally:
+            if profiler.enabled:
+                print(profiler.format_table(), file=sys.stderr)
+        if error is not None:
+            exit_status = -1
+        elif bootloader_difference:
+            exit_status = 1
+        else:
+            exit_status = 0
+        if args.output_format == "json":
+            print_json(build_report(
+                args.mlo,
+                args.uboot,
+                reports.values() if reports is not None else [],
+                bootloader_difference,
+                error,
+                exit_status,
+            ))
+        sys.exit(exit_status)
     # We need root to access block devices directly. Do this check after parsing
     # args so that the help message can be printed as a normal user.
     if os.geteuid() != 0:
@@ -905,22 +4083,85 @@ def main() -> None:
         if "am335x" not in model_name:
             log.error("This does not appear to be an AM335x device.")
             sys.exit(-1)
-    try:
-        bootloader_difference = update_raw_beaglebone(
+    journal = None
+    if args.journal is not None:
+        journal = UpdateJournal(args.journal)
+    elif os.path.exists(DEFAULT_JOURNAL_PATH):
+        # The journal is removed once everything in it is finished
+        log.warning(
+            "%s has unfinished updates in it, use --journal to finish them",
+            DEFAULT_JOURNAL_PATH,
+        )
+    if args.command == "daemon":
+        daemon = UpdaterDaemon(
             args.mlo,
             args.uboot,
-            args.devices,
-            args.action,
+            args.devices or DEFAULT_DEVICE_PATHS,
+            digest_cache,
+            journal,
+            args.delta_write,
+            args.direct_io,
+            args.verify_writes,
+            args.scan,
         )
-    except (ValueError, FileNotFoundError) as exc:
+        try:
+            run_daemon(daemon, args.socket)
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+    if args.devices is None:
+        args.devices = list(filter(os.path.exists, DEFAULT_DEVICE_PATHS))
+    reports = None
+    output = contextlib.nullcontext()
+    if args.output_format == "json":
+        reports = {device: DeviceReport(device) for device in args.devices}
+        # Keep stdout for the report
+        output = contextlib.redirect_stdout(sys.stderr)
+    error = None
+    bootloader_difference = False
+    try:
+        with output:
+            bootloader_difference = update_raw_beaglebone(
+                args.mlo,
+                args.uboot,
+                args.devices,
+                args.action,
+                digest_cache,
+                args.delta_write,
+                args.direct_io,
+                args.verify_writes,
+                reports,
+                args.scan,
+                journal,
+            )
+    except (
+        ValueError,
+        FileNotFoundError,
+        WriteVerificationError,
+        JournalError,
+    ) as exc:
         log.error("%s", exc)
-        sys.exit(-1)
+        error = str(exc)
     except KeyboardInterrupt:
-        sys.exit(-1)
-    if bootloader_difference:
-        sys.exit(1)
+        error = "Interrupted"
+    if profiler.enabled:
+        print(profiler.format_table(), file=sys.stderr)
+    if error is not None:
+        exit_status = -1
+    elif bootloader_difference:
+        exit_status = 1
     else:
-        sys.exit(0)
+        exit_status = 0
+    if reports is not None:
+        print_json(build_report(
+            args.mlo,
+            args.uboot,
+            reports.values(),
+            bootloader_difference,
+            error,
+            exit_status,
+        ))
+    sys.exit(exit_status)
 
 
 if __name__ == "__main__":